@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import argparse
+import resource
+import subprocess
+from datetime import datetime
+
+import create_tables
+from etl import load, get_files
+
+
+# tables loaded by each stage of the ETL
+STAGES = {
+    'song load': ['songs', 'artists'],
+    'time': ['time'],
+    'users': ['users'],
+    'songplays': ['songplays'],
+}
+
+
+def git_commit():
+    """Returns the short hash of the checked out commit, None outside of a git repository"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process and its finished children in MB"""
+    # ru_maxrss is in kilobytes on linux
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / 1024
+
+
+def run_benchmark(data, mode, lookup, workers, chunksize):
+    """Recreates the database, loads the data on given path and times each stage
+    Args:
+        data (str): directory holding song_data and log_data
+        mode (str): load mode of the ETL {row | bulk}
+        lookup (str): row mode song resolution of log files {memory | bounded | query}
+        workers (int): row mode number of processes loading files in parallel
+        chunksize (int): row mode number of records read at a time, whole files are read if None
+    Returns:
+        dict: benchmark result
+    """
+    cur, conn = create_tables.create_database()
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn)
+
+    song_filepath = os.path.join(data, 'song_data')
+    log_filepath = os.path.join(data, 'log_data')
+
+    start = time.time()
+    stats = load(cur, conn, song_filepath, log_filepath, mode=mode, lookup=lookup,
+                 workers=workers, chunksize=chunksize)
+    elapsed = time.time() - start
+    conn.close()
+
+    stages = {}
+    for stage, tables in STAGES.items():
+        rows = sum(stats.get(table, [0, 0.0])[0] for table in tables)
+        seconds = sum(stats.get(table, [0, 0.0])[1] for table in tables)
+        stages[stage] = {'rows': rows, 'seconds': round(seconds, 3),
+                         'rows_per_second': round(rows / seconds, 1) if seconds else None}
+
+    return {
+        'run_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'data': data,
+        'song_files': len(get_files(song_filepath)),
+        'log_files': len(get_files(log_filepath)),
+        'mode': mode,
+        'lookup': lookup,
+        'workers': workers,
+        'chunksize': chunksize,
+        'seconds': round(elapsed, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'stages': stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times each stage of the ETL against a local Postgres')
+    parser.add_argument('--data', default='data/generated',
+                        help='directory holding song_data and log_data, see generate_data.py')
+    parser.add_argument('--mode', choices=('row', 'bulk'), default='bulk')
+    parser.add_argument('--lookup', choices=('memory', 'bounded', 'query'), default='memory')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=None)
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='file the result is appended to as a json line')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.data, args.mode, args.lookup, args.workers, args.chunksize)
+
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+    print('{} mode, {} song files, {} log files in {:.2f}s, peak RSS {:.1f} MB'.format(
+        result['mode'], result['song_files'], result['log_files'], result['seconds'], result['peak_rss_mb']))
+    for stage, values in result['stages'].items():
+        print('{:<10} {:>9} rows in {:>8.2f}s ({} rows/s)'.format(
+            stage, values['rows'], values['seconds'], values['rows_per_second']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+import pandas as pd
+from etl import LOG_DTYPES, get_files, read_json_chunks
+from dimensions import build_time_df
+
+
+def make_log_file(filepath, scale):
+    """Writes a log file made of the bundled log files repeated scale times
+    Args:
+        filepath (str): filepath of the log file to write
+        scale (int): number of times the bundled log data is repeated
+    Returns:
+        int: size of the written file in bytes
+    """
+    lines = []
+    for f in sorted(get_files('data/log_data')):
+        with open(f) as log_file:
+            lines.extend(line.rstrip('\n') for line in log_file if line.strip())
+
+    with open(filepath, 'w') as log_file:
+        for i in range(scale):
+            log_file.write('\n'.join(lines))
+            log_file.write('\n')
+
+    return os.path.getsize(filepath)
+
+
+def read_log_file(filepath, chunksize):
+    """Reads a log file and builds the time, users and songplays records without loading them
+    Args:
+        filepath (str): filepath of log file
+        chunksize (int): number of records read at a time, whole file is read at once if None
+    Returns:
+        int: number of NextSong records read
+    """
+    rows = 0
+    for df in read_json_chunks(filepath, LOG_DTYPES, chunksize):
+        df = df[df['page']=='NextSong']
+        t = pd.to_datetime(df['ts'], unit='ms')
+        build_time_df(t.drop_duplicates())
+        df[['userId', 'firstName', 'lastName', 'gender', 'level']].sort_values('userId', kind='stable')
+        rows += len(df)
+    return rows
+
+
+def measure(filepath, chunksize):
+    """Reads a log file in a fresh process and returns its peak resident memory
+    Args:
+        filepath (str): filepath of log file
+        chunksize (int): number of records read at a time, whole file is read at once if None
+    Returns:
+        tuple: peak RSS in MB, seconds spent reading and number of NextSong records
+    """
+    command = [sys.executable, __file__, '--measure', filepath, '--chunksize', str(chunksize or 0)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout.split()
+    return float(output[0]), float(output[1]), int(output[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares peak memory of whole file and chunked log file reads')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 50],
+                        help='sizes of the generated log files as multiples of the bundled log data')
+    parser.add_argument('--chunksize', type=int, default=10000,
+                        help='number of records read at a time by the chunked reader')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        start = time.time()
+        rows = read_log_file(args.measure, args.chunksize or None)
+        # ru_maxrss is in kilobytes on linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(peak, time.time() - start, rows)
+        return
+
+    print('{:>10} {:>10} {:>12} {:>10} {:>12}'.format('file MB', 'chunksize', 'peak RSS MB', 'seconds', 'records'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            filepath = os.path.join(tmp, 'events-x{}.json'.format(scale))
+            size = make_log_file(filepath, scale) / 1024 / 1024
+            for chunksize in (None, args.chunksize):
+                peak, seconds, rows = measure(filepath, chunksize)
+                print('{:>10.1f} {:>10} {:>12.1f} {:>10.2f} {:>12}'.format(
+                    size, chunksize or 'whole', peak, seconds, rows))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import db
+from sql_queries import create_table_queries, create_index_queries, drop_table_queries, rebuild_create_table_queries
 
 
 def create_database():
@@ -9,7 +11,7 @@ def create_database():
     """
     
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = psycopg2.connect(db.get_dsn(dbname='studentdb'))
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
@@ -21,7 +23,7 @@ def create_database():
     conn.close()    
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = psycopg2.connect(db.get_dsn())
     cur = conn.cursor()
     
     return cur, conn
@@ -36,11 +38,16 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, rebuild=False):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list, and then the
+    indexes in `create_index_queries`.
+
+    With rebuild, creates the tables in `rebuild_create_table_queries` instead, without
+    keys and indexes. `etl.py --mode rebuild` adds them after loading the data.
     """
-    for query in create_table_queries:
+    queries = rebuild_create_table_queries if rebuild else create_table_queries + create_index_queries
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
@@ -54,14 +61,19 @@ def main():
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed, without keys and indexes with --rebuild. 
     
     - Finally, closes the connection. 
     """
+    parser = argparse.ArgumentParser(description='Creates sparkifydb and its tables')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='creates the tables without keys and indexes, to be loaded by etl.py --mode rebuild')
+    args = parser.parse_args()
+
     cur, conn = create_database()
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    create_tables(cur, conn, rebuild=args.rebuild)
 
     conn.close()
 
@@ -0,0 +1,166 @@
+import os
+import re
+import hashlib
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+from psycopg2.extensions import connection as _connection, make_dsn
+
+
+DEFAULT_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+# session settings for loads that can afford to lose the last commits on a server crash,
+# the data and the load manifest of a file are committed together so a rerun reloads them
+BULK_SESSION = {'synchronous_commit': 'off'}
+
+
+def get_dsn(dbname=None):
+    """Builds the connection string of the database, the SPARKIFY_DSN environment variable
+    wins over `DEFAULT_DSN`.
+    Args:
+        dbname (str): database to connect to instead of the configured one
+    Returns:
+        str: connection string
+    """
+    dsn = os.environ.get('SPARKIFY_DSN', DEFAULT_DSN)
+
+    if dbname:
+        dsn = make_dsn(dsn, dbname=dbname)
+    return dsn
+
+
+class PreparingConnection(_connection):
+    """psycopg2 connection remembering the statements prepared on its server session,
+    and whether its session settings are applied."""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+        self.tuned = False
+
+
+def tune(conn, session_settings=None):
+    """Sets the run-time parameters of a connection's session, and marks it tuned
+    Args:
+        conn (`PreparingConnection`): connection to the database
+        session_settings (dict): run-time parameters set on the session
+    Returns:
+        None
+    """
+    if session_settings:
+        with conn.cursor() as cur:
+            for name, value in session_settings.items():
+                cur.execute('SET {} = %s'.format(name), (value,))
+        conn.commit()
+    conn.tuned = True
+
+
+def connect(dsn, session_settings=None):
+    """Opens a connection that prepares the statements run with `execute`
+    Args:
+        dsn (str): connection string
+        session_settings (dict): run-time parameters set on the session
+    Returns:
+        `PreparingConnection`: connection to the database
+    """
+    conn = psycopg2.connect(dsn, connection_factory=PreparingConnection)
+    tune(conn, session_settings)
+    return conn
+
+
+def statement_name(query):
+    """Names a prepared statement after the hash of its query"""
+    return 'stmt_' + hashlib.md5(query.encode('utf8')).hexdigest()[:16]
+
+
+def execute(cur, query, params=()):
+    """Executes a query as a server-side prepared statement, so it is parsed and planned
+    once per connection. Cursors of plain psycopg2 connections execute the query as is.
+    psycopg2 has no call binding parameters to a prepared statement, so they are still sent
+    as literals of the `EXECUTE`, which the server parses instead of the whole query.
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        query (str): query with %s placeholders
+        params (sequence): parameters of the query
+    Returns:
+        None
+    """
+    prepared = getattr(cur.connection, 'prepared', None)
+    if prepared is None:
+        cur.execute(query, params)
+        return
+
+    name = statement_name(query)
+    if name not in prepared:
+        counter = iter(range(1, query.count('%s') + 1))
+        cur.execute('PREPARE {} AS {}'.format(name, re.sub('%s', lambda m: '${}'.format(next(counter)), query)))
+        prepared.add(name)
+
+    params = tuple(params)
+    if params:
+        cur.execute('EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(params))), params)
+    else:
+        cur.execute('EXECUTE {}'.format(name))
+
+
+class ConnectionPool:
+    """Thread-safe pool of `PreparingConnection`, tuned with the session settings on first use.
+
+    All connections are opened up front: psycopg2 closes a returned connection when the pool
+    already holds `minconn` idle ones, which would lose its prepared statements, so minconn is maxconn.
+
+    Attributes:
+        dsn (str): connection string
+        session_settings (dict): run-time parameters set on each connection
+    """
+
+    def __init__(self, dsn, maxconn=4, session_settings=None):
+        """Initializes a pool of connections.
+        Args:
+            dsn (str): connection string
+            maxconn (int): number of connections
+            session_settings (dict): run-time parameters set on each connection
+        """
+        self.dsn = dsn
+        self.session_settings = session_settings or {}
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            maxconn, maxconn, dsn, connection_factory=PreparingConnection)
+
+    def getconn(self):
+        """Takes a connection from the pool, sets the session settings on its first use
+        Returns:
+            `PreparingConnection`: connection to the database
+        """
+        conn = self._pool.getconn()
+        if not conn.tuned:
+            tune(conn, self.session_settings)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Returns a connection to the pool
+        Args:
+            conn (`PreparingConnection`): connection taken with `getconn`
+            close (bool): closes the connection instead of keeping it for reuse
+        """
+        self._pool.putconn(conn, close=close)
+
+    @contextmanager
+    def connection(self):
+        """Lends a connection, committed when the block succeeds and rolled back when it raises
+        Yields:
+            `PreparingConnection`: connection to the database
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        """Closes all connections of the pool"""
+        self._pool.closeall()
@@ -0,0 +1,161 @@
+import pandas as pd
+from psycopg2.extras import execute_values
+from sql_queries import time_keys_select, time_table_insert_values, user_table_insert_values
+
+
+def build_time_df(t):
+    """Breaks timestamps down into the columns of the time table
+    Args:
+        t (`pandas.Series`): datetime series of start times
+    Returns:
+        `pandas.DataFrame`: time records
+    """
+    t = pd.Series(t).reset_index(drop=True)
+    return pd.DataFrame({
+        'start_time': t,
+        'hour': t.dt.hour,
+        'day': t.dt.day,
+        'week': t.dt.isocalendar().week.astype(int),
+        'month': t.dt.month,
+        'year': t.dt.year,
+        'weekday': t.dt.weekday,
+    })
+
+
+class TimeDimension:
+    """Time dimension stage of a batch of log files.
+
+    Remembers the start times written during the batch and checks the time table
+    for the remaining ones, so each timestamp is written at most once no matter how
+    many records and files share it.
+    """
+
+    def __init__(self):
+        self.seen = pd.DatetimeIndex([])
+
+    def new_records(self, cur, t):
+        """Builds time records of the start times not yet in the time table
+        Args:
+            cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+            t (`pandas.Series`): datetime series of start times
+        Returns:
+            `pandas.DataFrame`: time records to be written
+        """
+        keys = pd.DatetimeIndex(pd.unique(pd.Series(t).dropna()))
+        keys = keys[~keys.isin(self.seen)]
+        if len(keys):
+            cur.execute(time_keys_select, (keys.min().to_pydatetime(), keys.max().to_pydatetime()))
+            existing = pd.DatetimeIndex([row[0] for row in cur.fetchall()])
+            self.seen = self.seen.append(keys[keys.isin(existing)])
+            keys = keys[~keys.isin(existing)]
+
+        return build_time_df(keys.sort_values().to_series())
+
+    def mark_written(self, time_df):
+        """Remembers the start times of written time records
+        Args:
+            time_df (`pandas.DataFrame`): time records written to the database
+        Returns:
+            None
+        """
+        self.seen = self.seen.append(pd.DatetimeIndex(time_df['start_time']))
+
+    def reset(self):
+        """Forgets the remembered start times, to be called when the batch transaction is rolled back
+        Returns:
+            None
+        """
+        self.seen = pd.DatetimeIndex([])
+
+    def load(self, cur, t):
+        """Writes the time records of the start times not yet in the time table
+        Args:
+            cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+            t (`pandas.Series`): datetime series of start times
+        Returns:
+            int: number of time records written
+        """
+        time_df = self.new_records(cur, t)
+        if len(time_df):
+            execute_values(cur, time_table_insert_values, time_df.itertuples(index=False, name=None))
+            self.mark_written(time_df)
+        return len(time_df)
+
+
+def build_user_df(df, t):
+    """Collapses log records to the latest record of each user
+    Args:
+        df (`pandas.DataFrame`): log records with userId, firstName, lastName, gender and level
+        t (`pandas.Series`): datetime series of the start times of the records
+    Returns:
+        `pandas.DataFrame`: one user record per user_id ordered by user_id, with the start time
+            of the latest record as last_seen
+    """
+    user_df = pd.DataFrame({
+        'user_id': pd.to_numeric(df['userId']).astype('int64'),
+        'first_name': df['firstName'],
+        'last_name': df['lastName'],
+        'gender': df['gender'],
+        'level': df['level'],
+        'last_seen': t,
+    })
+    user_df = user_df.sort_values('last_seen', kind='stable').drop_duplicates('user_id', keep='last')
+    return user_df.sort_values('user_id').reset_index(drop=True)
+
+
+class UserDimension:
+    """User dimension stage of a batch of log files.
+
+    Writes one record per user with the level of its latest event, and remembers the
+    last_seen written during the batch so users whose events are not newer are skipped.
+    The upsert only applies events newer than the stored last_seen, so files loaded in
+    any order or in parallel end up with the same level.
+    """
+
+    def __init__(self):
+        self.last_seen = pd.Series([], dtype='datetime64[ns]')
+
+    def new_records(self, df, t):
+        """Builds user records newer than the ones written during the batch
+        Args:
+            df (`pandas.DataFrame`): log records with userId, firstName, lastName, gender and level
+            t (`pandas.Series`): datetime series of the start times of the records
+        Returns:
+            `pandas.DataFrame`: user records to be written
+        """
+        user_df = build_user_df(df, t)
+        written = user_df['user_id'].map(self.last_seen)
+        return user_df[written.isnull() | (user_df['last_seen'] > written)]
+
+    def mark_written(self, user_df):
+        """Remembers the last_seen of written user records
+        Args:
+            user_df (`pandas.DataFrame`): user records written to the database
+        Returns:
+            None
+        """
+        written = user_df.set_index('user_id')['last_seen']
+        self.last_seen = pd.concat([self.last_seen[~self.last_seen.index.isin(written.index)], written])
+
+    def reset(self):
+        """Forgets the remembered users, to be called when the batch transaction is rolled back
+        Returns:
+            None
+        """
+        self.last_seen = pd.Series([], dtype='datetime64[ns]')
+
+    def load(self, cur, df, t):
+        """Upserts the latest record of each user in user_id order
+        Args:
+            cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+            df (`pandas.DataFrame`): log records with userId, firstName, lastName, gender and level
+            t (`pandas.Series`): datetime series of the start times of the records
+        Returns:
+            int: number of user records written
+        """
+        user_df = self.new_records(df, t)
+        if len(user_df):
+            execute_values(cur, user_table_insert_values, user_df.itertuples(index=False, name=None))
+            self.mark_written(user_df)
+        return len(user_df)
+
@@ -1,116 +1,707 @@
+import io
 import os
 import glob
+import time
+import argparse
+import functools
+import random
+import hashlib
+import multiprocessing
 import psycopg2
+import psycopg2.errors
 import pandas as pd
+import db
 from sql_queries import *
+from song_lookup import SongLookup, BoundedSongLookup
+from dimensions import TimeDimension, UserDimension
 
 
-def process_song_file(cur, filepath):
+DSN = db.get_dsn()
+
+# columns read from the files and their dtypes
+SONG_DTYPES = {'song_id': 'object', 'title': 'object', 'artist_id': 'object', 'year': 'int64',
+               'duration': 'float64', 'artist_name': 'object', 'artist_location': 'object',
+               'artist_latitude': 'float64', 'artist_longitude': 'float64'}
+LOG_DTYPES = {'page': 'object', 'ts': 'int64', 'userId': 'object', 'firstName': 'object',
+              'lastName': 'object', 'gender': 'object', 'level': 'object', 'song': 'object',
+              'artist': 'object', 'length': 'float64', 'sessionId': 'int64', 'location': 'object',
+              'userAgent': 'object'}
+
+# connection and lookup index of a worker process in parallel mode
+_worker = {}
+
+
+def add_stats(stats, table, rows, seconds):
+    """Accumulates row count and elapsed time of a table load into stats
+    Args:
+        stats (dict): table name -> [rows, seconds]
+        table (str): name of the loaded table
+        rows (int): number of records loaded
+        seconds (float): time spent loading the records
+    Returns:
+        None
+    """
+    entry = stats.setdefault(table, [0, 0.0])
+    entry[0] += rows
+    entry[1] += seconds
+
+
+def read_json_chunks(filepath, dtypes, chunksize=None):
+    """Reads line delimited json file with only the given columns, converted to the given dtypes
+    Args:
+        filepath (str): filepath of json file
+        dtypes (dict): column name -> dtype of the columns to be kept
+        chunksize (int): number of records read at a time, whole file is read at once if None
+    Yields:
+        `pandas.DataFrame`: records of the file, at most chunksize at a time
+    """
+    if chunksize is None:
+        df = pd.read_json(filepath, lines=True, dtype=dtypes, convert_dates=False)
+        yield df.reindex(columns=list(dtypes))
+        return
+
+    with pd.read_json(filepath, lines=True, dtype=dtypes, convert_dates=False, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield chunk.reindex(columns=list(dtypes))
+
+
+def process_song_file(cur, filepath, chunksize=None):
     """Processes song file and inserts into songs and artists tables
     Args:
         cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
         filepath (str): filepath of song file
+        chunksize (int): number of records read at a time, whole file is read at once if None
     Returns:
-        None
+        dict: table name -> [rows, seconds] for the inserted records
     """
+    stats = {}
+
     # open song file
-    df = pd.read_json(filepath, lines=True)
+    for df in read_json_chunks(filepath, SONG_DTYPES, chunksize):
 
-    # insert song record
-    song_data = df[['song_id','title','artist_id','year','duration']].values[0]
-    cur.execute(song_table_insert, song_data)
-    
-    # insert artist record
-    artist_data = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].values[0]
-    cur.execute(artist_table_insert, artist_data)
+        # insert song records
+        start = time.time()
+        song_data = df[['song_id','title','artist_id','year','duration']]
+        for row in song_data.itertuples(index=False, name=None):
+            db.execute(cur, song_table_insert, row)
+        add_stats(stats, 'songs', len(song_data), time.time() - start)
 
+        # insert artist records
+        start = time.time()
+        artist_data = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']]
+        for row in artist_data.itertuples(index=False, name=None):
+            db.execute(cur, artist_table_insert, row)
+        add_stats(stats, 'artists', len(artist_data), time.time() - start)
 
-def process_log_file(cur, filepath):
-    """Processes log file and inserts into time, users and songplays tables
+    return stats
+
+
+def process_log_records(cur, df, stats, lookup, time_dimension, user_dimension):
+    """Inserts log records into time, users and songplays tables
     Args:
         cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
-        filepath (str): filepath of log file
+        df (`pandas.DataFrame`): log records with the columns of `LOG_DTYPES`
+        stats (dict): table name -> [rows, seconds] to be updated
+        lookup (`SongLookup`): index resolving song and artist ids of the records,
+            `song_select` is queried for each record if None
+        time_dimension (`TimeDimension`): time stage shared by the records of a batch
+        user_dimension (`UserDimension`): user stage shared by the records of a batch
     Returns:
         None
     """
-    # open log file
-    df = pd.read_json(filepath,lines=True)
-
     # filter by NextSong action
     df = df[df['page']=='NextSong']
 
     # convert timestamp column to datetime
     t = pd.to_datetime(df['ts'], unit='ms')
-    
-    # insert time data records
-    time_data = (t, t.dt.hour, t.dt.day, t.dt.week, t.dt.month, t.dt.year, t.dt.weekday)
-    column_labels = ('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame(dict(zip(column_labels,time_data)))
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    # insert time records not yet written, in key order so concurrent loads lock rows in the same order
+    start = time.time()
+    add_stats(stats, 'time', time_dimension.load(cur, t), time.time() - start)
 
-    # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    # upsert the latest record of each user, in key order so concurrent loads lock rows in the same order
+    start = time.time()
+    add_stats(stats, 'users', user_dimension.load(cur, df, t), time.time() - start)
 
-    # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    # insert songplay records, replacing the ones of events loaded before so a changed file is not loaded twice
+    start = time.time()
+    if len(df):
+        db.execute(cur, songplay_events_delete, (t.dt.to_pydatetime().tolist(),
+                                                 pd.to_numeric(df['userId']).astype('int64').tolist(),
+                                                 df['sessionId'].tolist()))
+    if lookup is not None:
+        song_ids = lookup.resolve(df)
 
-    # insert songplay records
     for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
+
+        # get songid and artistid from lookup index or song and artist tables
+        if lookup is not None:
+            songid, artistid = song_ids.at[index, 'song_id'], song_ids.at[index, 'artist_id']
         else:
-            songid, artistid = None, None
+            db.execute(cur, song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
 
         # insert songplay record
-        songplay_data = (pd.to_datetime(row.ts, unit='ms'), row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+        songplay_data = (t[index], row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
+        db.execute(cur, songplay_table_insert, songplay_data)
+    add_stats(stats, 'songplays', len(df), time.time() - start)
 
 
-def process_data(cur, conn, filepath, func):
-    """Processes mulltiple files on given path with given function and connection
+def process_log_file(cur, filepath, lookup=None, time_dimension=None, user_dimension=None, chunksize=None):
+    """Processes log file and inserts into time, users and songplays tables
     Args:
         cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
-        conn (`psycopg2.extensions.connection`): connection for database
-        filepath (str): path of files to be processed
-        func (function): function to process the files for the file type
+        filepath (str): filepath of log file
+        lookup (`SongLookup`): index resolving song and artist ids of the whole file,
+            `song_select` is queried for each record if None
+        time_dimension (`TimeDimension`): time stage shared by the files of a batch,
+            the file is deduplicated on its own if None
+        user_dimension (`UserDimension`): user stage shared by the files of a batch,
+            the file is collapsed on its own if None
+        chunksize (int): number of records read at a time, whole file is read at once if None
     Returns:
-        None
+        dict: table name -> [rows, seconds] for the inserted records
+    """
+    stats = {}
+    if time_dimension is None:
+        time_dimension = TimeDimension()
+    if user_dimension is None:
+        user_dimension = UserDimension()
+
+    # open log file, streaming chunks keep peak memory bounded by chunksize instead of the file size
+    for df in read_json_chunks(filepath, LOG_DTYPES, chunksize):
+        process_log_records(cur, df, stats, lookup, time_dimension, user_dimension)
+
+    return stats
+
+
+def get_files(filepath):
+    """Collects all json files found under given path
+    Args:
+        filepath (str): root path to search for files
+    Returns:
+        list: absolute filepaths of json files
     """
-    # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
 
-    # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    return all_files
+
+
+def file_hash(filepath):
+    """Computes md5 hash of the content of a file
+    Args:
+        filepath (str): filepath of the file
+    Returns:
+        str: hex digest of the file content
+    """
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_new_files(cur, conn, all_files, reload=False):
+    """Selects the files not recorded in the load manifest or changed since they were loaded.
+    Files with a new mtime but the same content are only updated in the manifest.
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        all_files (list): filepaths of the files found
+        reload (bool): selects every file regardless of the manifest
+    Returns:
+        list: (path, size, mtime, content_hash) of the files to be loaded
+    """
+    cur.execute(load_manifest_select)
+    manifest = {path: (size, mtime, content_hash) for path, size, mtime, content_hash in cur.fetchall()}
+
+    new_files = []
+    for datafile in all_files:
+        stat = os.stat(datafile)
+        loaded = manifest.get(datafile)
+        if not reload and loaded and loaded[:2] == (stat.st_size, stat.st_mtime):
+            continue
+
+        fileinfo = (datafile, stat.st_size, stat.st_mtime, file_hash(datafile))
+        if not reload and loaded and loaded[2] == fileinfo[3]:
+            db.execute(cur, load_manifest_upsert, fileinfo)
+        else:
+            new_files.append(fileinfo)
+    conn.commit()
+
+    return new_files
+
+
+def process_data(cur, conn, filepath, func, reload=False, loaded=None):
+    """Processes mulltiple files on given path with given function and connection.
+    Only files that are new or changed since they were recorded in the load manifest are processed,
+    each file is recorded in the same transaction as its data.
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        filepath (str): path of files to be processed
+        func (function): function to process the files for the file type
+        reload (bool): processes every file regardless of the load manifest
+        loaded (list): filepaths of the processed files are appended to it, if set
+    Returns:
+        dict: table name -> [rows, seconds] accumulated over all files
+    """
+    stats = {}
+
+    # get all files matching extension from directory
+    all_files = get_files(filepath)
+
+    # get total number of files found and the ones to be loaded
+    new_files = get_new_files(cur, conn, all_files, reload)
+    num_files = len(new_files)
+    print('{} files found in {}, {} new or changed'.format(len(all_files), filepath, num_files))
 
     # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    for i, fileinfo in enumerate(new_files, 1):
+        for table, (rows, seconds) in func(cur, fileinfo[0]).items():
+            add_stats(stats, table, rows, seconds)
+        db.execute(cur, load_manifest_upsert, fileinfo)
         conn.commit()
+        if loaded is not None:
+            loaded.append(fileinfo[0])
         print('{}/{} files processed.'.format(i, num_files))
 
+    return stats
+
+
+def init_worker(dsn, session_settings, lookup_mode, lookup_size, chunksize=None):
+    """Opens the database connection of a worker process, the statements it prepares are
+    reused for every file the worker processes
+    Args:
+        dsn (str): connection string of the database
+        session_settings (dict): run-time parameters set on the session
+        lookup_mode (str): song resolution of log files {memory | bounded | query}
+        lookup_size (int): maximum number of keys held by the bounded lookup index
+        chunksize (int): number of records read at a time, whole files are read at once if None
+    Returns:
+        None
+    """
+    conn = db.connect(dsn, session_settings)
+    _worker.update(conn=conn, cur=conn.cursor(), lookup_mode=lookup_mode, lookup_size=lookup_size,
+                   chunksize=chunksize, time_dimension=TimeDimension(), user_dimension=UserDimension())
+
+
+def get_worker_lookup():
+    """Builds the song lookup index of a worker process on first use, after the song files are loaded
+    Returns:
+        `SongLookup`: lookup index, None if `song_select` is queried for each record
+    """
+    if 'lookup' not in _worker:
+        if _worker['lookup_mode'] == 'memory':
+            _worker['lookup'] = SongLookup.from_database(_worker['cur'])
+        elif _worker['lookup_mode'] == 'bounded':
+            _worker['lookup'] = BoundedSongLookup(_worker['cur'], max_entries=_worker['lookup_size'])
+        else:
+            _worker['lookup'] = None
+    return _worker['lookup']
+
+
+def process_file_in_worker(task, retries=8):
+    """Processes a single file on the connection of a worker process and commits it.
+    Transactions aborted by a deadlock with another worker are retried after a random exponential backoff.
+    Args:
+        task (tuple): function to process the file with and (path, size, mtime, content_hash) of the file
+        retries (int): number of attempts for a file
+    Returns:
+        tuple: filepath and table name -> [rows, seconds] for the file
+    """
+    func, fileinfo = task
+    datafile = fileinfo[0]
+    cur, conn = _worker['cur'], _worker['conn']
+
+    for attempt in range(1, retries + 1):
+        try:
+            if func is process_log_file:
+                file_stats = func(cur, datafile, lookup=get_worker_lookup(),
+                                  time_dimension=_worker['time_dimension'],
+                                  user_dimension=_worker['user_dimension'], chunksize=_worker['chunksize'])
+            else:
+                file_stats = func(cur, datafile, chunksize=_worker['chunksize'])
+            db.execute(cur, load_manifest_upsert, fileinfo)
+            conn.commit()
+            return datafile, file_stats
+        except (psycopg2.errors.DeadlockDetected, psycopg2.errors.SerializationFailure):
+            conn.rollback()
+            _worker['time_dimension'].reset()
+            _worker['user_dimension'].reset()
+            if attempt == retries:
+                raise
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+
+def process_data_parallel(pool, cur, conn, filepath, func, reload=False):
+    """Processes mulltiple files on given path with given function on a pool of worker processes
+    Args:
+        pool (`multiprocessing.pool.Pool`): pool of processes set up with `init_worker`
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection, used to read the load manifest
+        conn (`psycopg2.extensions.connection`): connection for database
+        filepath (str): path of files to be processed
+        func (function): function to process the files for the file type
+        reload (bool): processes every file regardless of the load manifest
+    Returns:
+        dict: table name -> [rows, seconds] accumulated over all files and workers
+    """
+    stats = {}
+
+    all_files = get_files(filepath)
+    new_files = get_new_files(cur, conn, all_files, reload)
+    num_files = len(new_files)
+    print('{} files found in {}, {} new or changed'.format(len(all_files), filepath, num_files))
+
+    # returns once every file is committed, so log files never start before all song files are loaded
+    tasks = [(func, fileinfo) for fileinfo in new_files]
+    for i, (datafile, file_stats) in enumerate(pool.imap_unordered(process_file_in_worker, tasks), 1):
+        for table, (rows, seconds) in file_stats.items():
+            add_stats(stats, table, rows, seconds)
+        print('{}/{} files processed.'.format(i, num_files))
+
+    return stats
+
+
+def copy_from_dataframe(cur, df, table):
+    """Streams the records of a DataFrame into a table with COPY FROM STDIN
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        df (`pandas.DataFrame`): records to copy, columns named after the table columns
+        table (str): name of the target table
+    Returns:
+        None
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep='\\N')
+    buf.seek(0)
+    cur.copy_expert(copy_from_stdin.format(table=table, columns=', '.join(df.columns)), buf)
+
+
+def bulk_load_table(cur, table, df, stats, queries=bulk_load_queries):
+    """Copies records into a temp staging table and merges them into the target table,
+    the caller commits the transaction
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        table (str): name of the target table, key of queries
+        df (`pandas.DataFrame`): records to load
+        stats (dict): table name -> [rows, seconds] to be updated
+        queries (dict): table name -> (staging table, staging create, merge statement or statements)
+    Returns:
+        None
+    """
+    stage_table, stage_create, merge = queries[table]
+
+    start = time.time()
+    cur.execute(stage_create)
+    copy_from_dataframe(cur, df, stage_table)
+    for query in [merge] if isinstance(merge, str) else merge:
+        cur.execute(query)
+    add_stats(stats, table, len(df), time.time() - start)
+
+
+def read_json_files(filepaths, dtypes):
+    """Reads line delimited json files into a single DataFrame
+    Args:
+        filepaths (list): filepaths of json files
+        dtypes (dict): column name -> dtype of the columns to be kept
+    Returns:
+        `pandas.DataFrame`: records of all files
+    """
+    return pd.concat([df for f in filepaths for df in read_json_chunks(f, dtypes)], ignore_index=True)
+
+
+def get_new_files_bulk(cur, conn, filepath, reload):
+    """Selects new or changed files on given path for a bulk load
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        filepath (str): path of files to be loaded
+        reload (bool): selects every file regardless of the load manifest
+    Returns:
+        list: (path, size, mtime, content_hash) of the files to be loaded
+    """
+    all_files = get_files(filepath)
+    new_files = get_new_files(cur, conn, all_files, reload)
+    print('{} files found in {}, {} new or changed'.format(len(all_files), filepath, len(new_files)))
+    return new_files
+
+
+def process_song_files_bulk(cur, conn, filepath, reload=False, queries=bulk_load_queries):
+    """Loads new or changed song files into songs and artists tables with COPY,
+    the files are recorded in the load manifest in the same transaction
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        filepath (str): path of song files
+        reload (bool): loads every file regardless of the load manifest
+        queries (dict): table name -> (staging table, staging create, merge statement or statements)
+    Returns:
+        dict: table name -> [rows, seconds] for the loaded records
+    """
+    stats = {}
+    new_files = get_new_files_bulk(cur, conn, filepath, reload)
+    if not new_files:
+        return stats
+
+    df = read_json_files([fileinfo[0] for fileinfo in new_files], SONG_DTYPES)
+
+    song_df = df[['song_id', 'title', 'artist_id', 'year', 'duration']]
+    bulk_load_table(cur, 'songs', song_df, stats, queries)
+
+    artist_df = df[['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']].rename(
+        columns={'artist_name': 'name', 'artist_location': 'location',
+                 'artist_latitude': 'latitude', 'artist_longitude': 'longitude'})
+    bulk_load_table(cur, 'artists', artist_df, stats, queries)
+
+    cur.executemany(load_manifest_upsert, new_files)
+    conn.commit()
+
+    return stats
+
+
+def process_log_files_bulk(cur, conn, filepath, reload=False, queries=bulk_load_queries):
+    """Loads new or changed log files into time, users and songplays tables with COPY,
+    the files are recorded in the load manifest in the same transaction
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        filepath (str): path of log files
+        reload (bool): loads every file regardless of the load manifest
+        queries (dict): table name -> (staging table, staging create, merge statement or statements)
+    Returns:
+        dict: table name -> [rows, seconds] for the loaded records
+    """
+    stats = {}
+    new_files = get_new_files_bulk(cur, conn, filepath, reload)
+    if not new_files:
+        return stats
+
+    df = read_json_files([fileinfo[0] for fileinfo in new_files], LOG_DTYPES)
+
+    # filter by NextSong action
+    df = df[df['page']=='NextSong']
+    t = pd.to_datetime(df['ts'], unit='ms')
+    user_id = pd.to_numeric(df['userId']).astype('Int64')
+    session_id = df['sessionId']
+
+    time_df = TimeDimension().new_records(cur, t)
+    bulk_load_table(cur, 'time', time_df, stats, queries)
+
+    user_df = UserDimension().new_records(df, t)
+    bulk_load_table(cur, 'users', user_df, stats, queries)
+
+    songplay_df = pd.DataFrame({'start_time': t, 'user_id': user_id, 'level': df['level'],
+                                'song': df['song'], 'artist': df['artist'], 'length': df['length'],
+                                'session_id': session_id, 'location': df['location'],
+                                'user_agent': df['userAgent']})
+    bulk_load_table(cur, 'songplays', songplay_df, stats, queries)
+
+    cur.executemany(load_manifest_upsert, new_files)
+    conn.commit()
+
+    return stats
+
+
+def has_constraints(cur):
+    """Checks whether any primary key of `rebuild_primary_keys` is already in place
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+    Returns:
+        bool: True if the tables were not created for a rebuild
+    """
+    for table, column in rebuild_primary_keys:
+        cur.execute(constraint_exists, ('{}_pkey'.format(table),))
+        if cur.fetchone()[0]:
+            return True
+    return False
+
+
+def add_constraints(cur, conn):
+    """Adds the primary keys, foreign keys and indexes left out of the tables created for a rebuild.
+    Violations are counted per constraint instead of failing the load: rows sharing or
+    lacking a primary key are deleted except the first one in `rebuild_primary_key_order`,
+    the latest one for users, and a foreign key with rows referencing missing keys is
+    added NOT VALID, so only new rows are checked against it.
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+    Returns:
+        list: (constraint name, violating rows, action taken) of each added constraint
+    """
+    report = []
+
+    for table, column in rebuild_primary_keys:
+        name = '{}_pkey'.format(table)
+        cur.execute(constraint_exists, (name,))
+        if cur.fetchone()[0]:
+            continue
+        cur.execute(primary_key_violations.format(table=table, column=column))
+        violations = cur.fetchone()[0]
+        if violations:
+            order = rebuild_primary_key_order.get(table, 'ctid')
+            cur.execute(primary_key_dedupe.format(table=table, column=column, order=order))
+        cur.execute(primary_key_add.format(table=table, column=column))
+        report.append((name, violations, 'rows deleted' if violations else 'ok'))
+
+    for table, column, ref_table, ref_column in rebuild_foreign_keys:
+        name = '{}_{}_fkey'.format(table, column)
+        cur.execute(constraint_exists, (name,))
+        if cur.fetchone()[0]:
+            continue
+        keys = dict(table=table, column=column, ref_table=ref_table, ref_column=ref_column)
+        cur.execute(foreign_key_violations.format(**keys))
+        violations = cur.fetchone()[0]
+        cur.execute(foreign_key_add.format(not_valid='NOT VALID' if violations else '', **keys))
+        report.append((name, violations, 'added NOT VALID' if violations else 'ok'))
+
+    for query in create_index_queries:
+        cur.execute(query)
+    conn.commit()
+
+    for table, column in rebuild_primary_keys:
+        cur.execute('ANALYZE {}'.format(table))
+    conn.commit()
+
+    return report
+
+
+def print_constraint_report(report):
+    """Prints the violating rows found for each constraint added after a rebuild
+    Args:
+        report (list): (constraint name, violating rows, action taken)
+    Returns:
+        None
+    """
+    for name, violations, action in report:
+        print('{:<26} {:>9} violating rows, {}'.format(name, violations, action))
+
+
+def print_load_report(stats):
+    """Prints number of records and rows per second for each loaded table
+    Args:
+        stats (dict): table name -> [rows, seconds]
+    Returns:
+        None
+    """
+    for table, (rows, seconds) in stats.items():
+        rate = rows / seconds if seconds else float('inf')
+        print('{:<10} {:>9} rows in {:>8.2f}s ({:.0f} rows/s)'.format(table, rows, seconds, rate))
+
+
+def load(cur, conn, song_filepath, log_filepath, mode='row', lookup='memory', lookup_size=100000,
+         workers=1, chunksize=None, reload=False, session_settings=db.BULK_SESSION):
+    """Loads the song files and then the log files on given paths
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        song_filepath (str): path of song files
+        log_filepath (str): path of log files
+        mode (str): row: insert records one by one, bulk: COPY into staging tables and merge,
+            rebuild: bulk load into tables created by `create_tables.py --rebuild`, then add keys and indexes
+        lookup (str): row mode song resolution of log files {memory | bounded | query}
+        lookup_size (int): maximum number of keys held by the bounded lookup index
+        workers (int): row mode number of processes loading files in parallel
+        chunksize (int): row mode number of records read at a time, whole files are read if None
+        reload (bool): loads every file regardless of the load manifest
+        session_settings (dict): run-time parameters set on the sessions of parallel workers
+    Returns:
+        dict: table name -> [rows, seconds] for the loaded records
+    """
+    cur.execute(load_manifest_table_create)
+    conn.commit()
+
+    stats = {}
+    if mode == 'rebuild' and has_constraints(cur):
+        print('Tables already have their keys, loading in bulk mode')
+        mode = 'bulk'
+
+    if mode == 'bulk':
+        stats.update(process_song_files_bulk(cur, conn, song_filepath, reload=reload))
+        stats.update(process_log_files_bulk(cur, conn, log_filepath, reload=reload))
+    elif mode == 'rebuild':
+        stats.update(process_song_files_bulk(cur, conn, song_filepath, reload=reload, queries=rebuild_load_queries))
+        stats.update(process_log_files_bulk(cur, conn, log_filepath, reload=reload, queries=rebuild_load_queries))
+        start = time.time()
+        print_constraint_report(add_constraints(cur, conn))
+        print('Keys and indexes added in {:.2f}s'.format(time.time() - start))
+    elif workers > 1:
+        start = time.time()
+        with multiprocessing.Pool(workers, initializer=init_worker,
+                                  initargs=(DSN, session_settings, lookup, lookup_size, chunksize)) as pool:
+            stats.update(process_data_parallel(pool, cur, conn, filepath=song_filepath,
+                                               func=process_song_file, reload=reload))
+            stats.update(process_data_parallel(pool, cur, conn, filepath=log_filepath,
+                                               func=process_log_file, reload=reload))
+        print('Loaded by {} workers in {:.2f}s, per table times below are summed over workers'.format(
+            workers, time.time() - start))
+    else:
+        # the index is built from the songs of earlier runs and refreshed with the song files of this one
+        song_lookup = None
+        if lookup == 'memory':
+            song_lookup = SongLookup.from_database(cur)
+        elif lookup == 'bounded':
+            song_lookup = BoundedSongLookup(cur, max_entries=lookup_size)
+
+        new_song_files = []
+        stats.update(process_data(cur, conn, filepath=song_filepath,
+                                  func=functools.partial(process_song_file, chunksize=chunksize),
+                                  reload=reload, loaded=new_song_files))
+        if song_lookup is not None:
+            song_lookup.add_song_files(new_song_files)
+
+        stats.update(process_data(cur, conn, filepath=log_filepath,
+                                  func=functools.partial(process_log_file, lookup=song_lookup,
+                                                         time_dimension=TimeDimension(),
+                                                         user_dimension=UserDimension(),
+                                                         chunksize=chunksize),
+                                  reload=reload))
+
+    return stats
+
 
 def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description='Loads song and log data into sparkifydb')
+    parser.add_argument('--mode', choices=('row', 'bulk', 'rebuild'), default='row',
+                        help='row: insert records one by one, bulk: COPY into staging tables and merge, '
+                             'rebuild: bulk load into tables created by create_tables.py --rebuild, '
+                             'then add keys and indexes')
+    parser.add_argument('--lookup', choices=('memory', 'bounded', 'query'), default='memory',
+                        help='row mode song resolution, memory: index of all songs, '
+                             'bounded: LRU index filled from the database, query: song_select per record')
+    parser.add_argument('--lookup-size', type=int, default=100000,
+                        help='maximum number of keys held by the bounded lookup index')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='row mode number of processes loading files in parallel, each with its own connection')
+    parser.add_argument('--reload', action='store_true',
+                        help='loads every file, including the ones already recorded in the load manifest')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='row mode number of records read from a file at a time, whole files are read if not set')
+    parser.add_argument('--synchronous-commit', action='store_true',
+                        help='waits for each commit to be flushed, by default the last commits may be '
+                             'lost on a server crash and their files are loaded again by the next run')
+    args = parser.parse_args()
+
+    session_settings = {} if args.synchronous_commit else db.BULK_SESSION
+    conn = db.connect(DSN, session_settings)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    stats = load(cur, conn, 'data/song_data', 'data/log_data', mode=args.mode, lookup=args.lookup,
+                 lookup_size=args.lookup_size, workers=args.workers, chunksize=args.chunksize,
+                 reload=args.reload, session_settings=session_settings)
+    print_load_report(stats)
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
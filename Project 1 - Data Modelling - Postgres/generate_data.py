@@ -0,0 +1,156 @@
+import os
+import json
+import random
+import string
+import argparse
+from datetime import datetime, timedelta
+
+import pandas as pd
+from etl import get_files
+
+
+# number of song files and log events in the bundled sample, a scale of 1 generates the same amount
+SAMPLE_SONGS = 71
+SAMPLE_EVENTS = 8056
+
+OTHER_PAGES = ['Home', 'Login', 'Logout', 'Downgrade', 'Settings', 'Help', 'About', 'Upgrade']
+FIRST_NAMES = ['Jayden', 'Kaylee', 'Walter', 'Lily', 'Jacob', 'Chloe', 'Tegan', 'Aleena', 'Ryan', 'Sara']
+LAST_NAMES = ['Bell', 'Summers', 'Frye', 'Koch', 'Klein', 'Cuevas', 'Levine', 'Kirby', 'Smith', 'Johnson']
+WORDS = ['love', 'night', 'dance', 'heart', 'fire', 'rain', 'dream', 'home', 'blue', 'road',
+         'light', 'shadow', 'river', 'gold', 'storm', 'summer', 'city', 'girl', 'time', 'song']
+
+
+def random_id(rng, prefix):
+    """Generates a Million Song Dataset style id like SOMZWCG12A8C13C480"""
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+
+
+def random_title(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title()
+
+
+def sample_values():
+    """Collects locations and user agents of the bundled log data to be reused in generated events"""
+    df = pd.concat([pd.read_json(f, lines=True) for f in get_files('data/log_data')])
+    return sorted(df['location'].dropna().unique()), sorted(df['userAgent'].dropna().unique())
+
+
+def generate_songs(rng, output, num_songs):
+    """Writes one song file per song under output/song_data
+    Args:
+        rng (`random.Random`): random generator
+        output (str): root directory of the generated data
+        num_songs (int): number of songs to generate
+    Returns:
+        list: generated song records
+    """
+    num_artists = max(1, int(num_songs * 0.9))
+    artists = [{'artist_id': random_id(rng, 'AR'),
+                'artist_latitude': rng.choice([None, round(rng.uniform(-90, 90), 5)]),
+                'artist_longitude': rng.choice([None, round(rng.uniform(-180, 180), 5)]),
+                'artist_location': rng.choice(['', 'California - LA', 'New York, NY', 'London, England']),
+                'artist_name': random_title(rng)} for _ in range(num_artists)]
+
+    songs = []
+    for _ in range(num_songs):
+        song = {'num_songs': 1}
+        song.update(rng.choice(artists))
+        song.update({'song_id': random_id(rng, 'SO'),
+                     'title': random_title(rng),
+                     'duration': round(rng.uniform(60, 600), 5),
+                     'year': rng.choice([0, rng.randint(1960, 2010)])})
+        songs.append(song)
+
+        track_id = random_id(rng, 'TR')
+        song_dir = os.path.join(output, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+
+    return songs
+
+
+def generate_logs(rng, output, num_events, songs, num_users, match_rate, days=30):
+    """Writes one log file per day under output/log_data
+    Args:
+        rng (`random.Random`): random generator
+        output (str): root directory of the generated data
+        num_events (int): number of events to generate
+        songs (list): song records that NextSong events are matched against
+        num_users (int): number of distinct users
+        match_rate (float): share of NextSong events that play one of the generated songs
+        days (int): number of days the events are spread over
+    Returns:
+        int: number of NextSong events generated
+    """
+    locations, user_agents = sample_values()
+    users = [{'userId': str(user_id),
+              'firstName': rng.choice(FIRST_NAMES),
+              'lastName': rng.choice(LAST_NAMES),
+              'gender': rng.choice('MF'),
+              'level': rng.choice(['free', 'paid']),
+              'location': rng.choice(locations),
+              'userAgent': rng.choice(user_agents),
+              'registration': float(rng.randint(1538000000000, 1541000000000))}
+             for user_id in range(1, num_users + 1)]
+
+    start = datetime(2018, 11, 1)
+    session_id = 0
+    next_songs = 0
+    events_per_day = num_events // days
+
+    for day in range(days):
+        date = start + timedelta(days=day)
+        day_start = int((date - datetime(1970, 1, 1)).total_seconds() * 1000)
+        events = []
+        while len(events) < events_per_day:
+            session_id += 1
+            user = rng.choice(users)
+            if rng.random() < 0.02:
+                user['level'] = 'paid' if user['level'] == 'free' else 'free'
+            ts = day_start + rng.randint(0, 86000000)
+            for item in range(min(rng.randint(1, 40), events_per_day - len(events))):
+                ts += rng.randint(1000, 300000)
+                event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'],
+                         'gender': user['gender'], 'itemInSession': item, 'lastName': user['lastName'],
+                         'length': None, 'level': user['level'], 'location': user['location'],
+                         'method': 'GET', 'page': rng.choice(OTHER_PAGES),
+                         'registration': user['registration'], 'sessionId': session_id, 'song': None,
+                         'status': 200, 'ts': ts, 'userAgent': user['userAgent'], 'userId': user['userId']}
+                if rng.random() < 0.85:
+                    if songs and rng.random() < match_rate:
+                        song = rng.choice(songs)
+                        played = (song['artist_name'], song['duration'], song['title'])
+                    else:
+                        played = (random_title(rng), round(rng.uniform(60, 600), 5), random_title(rng))
+                    event.update(zip(('artist', 'length', 'song'), played), method='PUT', page='NextSong')
+                    next_songs += 1
+                events.append(event)
+
+        log_dir = os.path.join(output, 'log_data', date.strftime('%Y'), date.strftime('%m'))
+        os.makedirs(log_dir, exist_ok=True)
+        with open(os.path.join(log_dir, date.strftime('%Y-%m-%d-events.json')), 'w') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+
+    return next_songs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates song and log files with the schema of the Sparkify data')
+    parser.add_argument('--output', default='data/generated', help='directory the song_data and log_data are written to')
+    parser.add_argument('--scale', type=int, default=10, help='size as a multiple of the bundled sample data')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='share of NextSong events that play one of the generated songs')
+    parser.add_argument('--users', type=int, default=1000, help='number of distinct users')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    songs = generate_songs(rng, args.output, SAMPLE_SONGS * args.scale)
+    next_songs = generate_logs(rng, args.output, SAMPLE_EVENTS * args.scale, songs, args.users, args.match_rate)
+    print('{} song files and {} NextSong events written to {}'.format(len(songs), next_songs, args.output))
+
+
+if __name__ == "__main__":
+    main()
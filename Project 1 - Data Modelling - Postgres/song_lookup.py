@@ -0,0 +1,162 @@
+from collections import OrderedDict
+
+import pandas as pd
+from sql_queries import song_lookup_select, song_lookup_keys_select
+
+
+LOOKUP_KEYS = ['title', 'name', 'duration']
+LOOKUP_COLUMNS = LOOKUP_KEYS + ['song_id', 'artist_id']
+
+
+def _to_lookup_frame(df):
+    """Normalizes song records into the columns and types of the lookup index"""
+    df = pd.DataFrame(df, columns=LOOKUP_COLUMNS)
+    df['duration'] = df['duration'].astype(float)
+    return df
+
+
+def _merge_ids(df, index, title, name, duration):
+    """Left joins song_id and artist_id of the index onto the events of a DataFrame
+    Args:
+        df (`pandas.DataFrame`): events to resolve
+        index (`pandas.DataFrame`): lookup records with `LOOKUP_COLUMNS`
+        title (str): column of df holding the song title
+        name (str): column of df holding the artist name
+        duration (str): column of df holding the song duration
+    Returns:
+        `pandas.DataFrame`: song_id and artist_id for each row of df, None if not found
+    """
+    keys = pd.DataFrame({'title': df[title].values,
+                         'name': df[name].values,
+                         'duration': df[duration].astype(float).values})
+    ids = keys.merge(index, on=LOOKUP_KEYS, how='left')[['song_id', 'artist_id']]
+    ids.index = df.index
+    return ids.astype(object).where(ids.notnull(), None)
+
+
+class SongLookup:
+    """In-memory index of songs and artists keyed on (title, artist name, duration).
+
+    Resolves the song_id and artist_id of a whole log file with a single pandas merge,
+    matching the same records as the `song_select` query.
+    """
+
+    def __init__(self, songs=None):
+        """Initializes a lookup index.
+        Args:
+            songs (`pandas.DataFrame`): records with `LOOKUP_COLUMNS`, empty index if None
+        """
+        self.index = _to_lookup_frame(songs)
+        self.index = self.index.drop_duplicates(LOOKUP_KEYS)
+
+    @classmethod
+    def from_database(cls, cur):
+        """Builds the index from the loaded songs and artists tables.
+        Args:
+            cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        Returns:
+            `SongLookup`: lookup index
+        """
+        cur.execute(song_lookup_select)
+        return cls(pd.DataFrame(cur.fetchall(), columns=LOOKUP_COLUMNS))
+
+    def __len__(self):
+        return len(self.index)
+
+    def add_song_files(self, filepaths):
+        """Adds the songs of new song files to the index.
+        Args:
+            filepaths (list): filepaths of song files
+        Returns:
+            None
+        """
+        if not filepaths:
+            return
+        df = pd.concat([pd.read_json(f, lines=True) for f in filepaths], ignore_index=True)
+        df = df.rename(columns={'artist_name': 'name'})
+        self.index = pd.concat([self.index, _to_lookup_frame(df)], ignore_index=True)
+        self.index = self.index.drop_duplicates(LOOKUP_KEYS)
+
+    def resolve(self, df, title='song', name='artist', duration='length'):
+        """Resolves song_id and artist_id of log events.
+        Args:
+            df (`pandas.DataFrame`): log events
+            title (str): column of df holding the song title
+            name (str): column of df holding the artist name
+            duration (str): column of df holding the song duration
+        Returns:
+            `pandas.DataFrame`: song_id and artist_id for each row of df, None if not found
+        """
+        return _merge_ids(df, self.index, title, name, duration)
+
+
+class BoundedSongLookup:
+    """Lookup index holding at most `max_entries` keys, filled on demand from the database.
+
+    Keys missing from the cache are fetched with one query per resolved batch and the
+    least recently used keys are evicted. Misses are cached too, `add_song_files` replaces
+    them with the songs of new song files.
+    """
+
+    def __init__(self, cur, max_entries=100000):
+        """Initializes a bounded lookup index.
+        Args:
+            cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+            max_entries (int): maximum number of keys kept in memory
+        """
+        self.cur = cur
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def _fetch(self, keys):
+        """Fetches song_id and artist_id of given keys from the database"""
+        titles, names, durations = (list(column) for column in zip(*keys))
+        self.cur.execute(song_lookup_keys_select, (titles, names, durations))
+        found = {}
+        for title, name, duration, song_id, artist_id in self.cur.fetchall():
+            found.setdefault((title, name, float(duration)), (song_id, artist_id))
+        return found
+
+    def _store(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    def add_song_files(self, filepaths):
+        """Adds the songs of new song files to the cache.
+        Args:
+            filepaths (list): filepaths of song files
+        Returns:
+            None
+        """
+        for f in filepaths:
+            df = pd.read_json(f, lines=True)
+            for row in df.itertuples():
+                self._store((row.title, row.artist_name, float(row.duration)), (row.song_id, row.artist_id))
+
+    def resolve(self, df, title='song', name='artist', duration='length'):
+        """Resolves song_id and artist_id of log events.
+        Args:
+            df (`pandas.DataFrame`): log events
+            title (str): column of df holding the song title
+            name (str): column of df holding the artist name
+            duration (str): column of df holding the song duration
+        Returns:
+            `pandas.DataFrame`: song_id and artist_id for each row of df, None if not found
+        """
+        keys = set(zip(df[title], df[name], df[duration].astype(float)))
+        missing = [key for key in keys if key not in self.cache]
+        found = self._fetch(missing) if missing else {}
+
+        records = []
+        for key in keys:
+            value = self.cache[key] if key in self.cache else found.get(key)
+            self._store(key, value)
+            if value is not None:
+                records.append(key + value)
+
+        return _merge_ids(df, _to_lookup_frame(records), title, name, duration)
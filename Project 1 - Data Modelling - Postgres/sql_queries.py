@@ -5,6 +5,7 @@ user_table_drop = "DROP TABLE IF EXISTS users CASCADE"
 song_table_drop = "DROP TABLE IF EXISTS songs CASCADE"
 artist_table_drop = "DROP TABLE IF EXISTS artists CASCADE"
 time_table_drop = "DROP TABLE IF EXISTS time CASCADE"
+load_manifest_table_drop = "DROP TABLE IF EXISTS load_manifest"
 
 # CREATE TABLES
 
@@ -27,7 +28,8 @@ CREATE TABLE IF NOT EXISTS users (
     first_name VARCHAR,
     last_name VARCHAR, 
     gender CHAR(1), 
-    level VARCHAR);
+    level VARCHAR, 
+    last_seen TIMESTAMP);
 """)
 
 song_table_create = ("""
@@ -59,6 +61,135 @@ CREATE TABLE IF NOT EXISTS time (
     weekday INT);
 """)
 
+load_manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_manifest (
+    path VARCHAR PRIMARY KEY, 
+    size BIGINT, 
+    mtime DOUBLE PRECISION, 
+    content_hash CHAR(32), 
+    loaded_at TIMESTAMP DEFAULT now());
+""")
+
+# CREATE TABLES WITHOUT CONSTRAINTS (REBUILD), ADDED AFTER THE LOAD BY THE QUERIES BELOW
+
+songplay_table_create_unconstrained = ("""
+CREATE TABLE IF NOT EXISTS songplays (
+    songplay_id SERIAL, 
+    start_time TIMESTAMP, 
+    user_id INT, 
+    level VARCHAR, 
+    song_id VARCHAR, 
+    artist_id VARCHAR, 
+    session_id INT, 
+    location VARCHAR, 
+    user_agent VARCHAR);
+""")
+
+user_table_create_unconstrained = ("""
+CREATE TABLE IF NOT EXISTS users (
+    user_id INT,
+    first_name VARCHAR,
+    last_name VARCHAR, 
+    gender CHAR(1), 
+    level VARCHAR, 
+    last_seen TIMESTAMP);
+""")
+
+song_table_create_unconstrained = ("""
+CREATE TABLE IF NOT EXISTS songs (
+    song_id VARCHAR, 
+    title VARCHAR, 
+    artist_id VARCHAR, 
+    year INT, 
+    duration NUMERIC);
+""")
+
+artist_table_create_unconstrained = ("""
+CREATE TABLE IF NOT EXISTS artists (
+    artist_id VARCHAR,
+    name VARCHAR, 
+    location VARCHAR, 
+    latitude NUMERIC, 
+    longitude NUMERIC);
+""")
+
+time_table_create_unconstrained = ("""
+CREATE TABLE IF NOT EXISTS time (
+    start_time TIMESTAMP, 
+    hour INT, 
+    day INT, 
+    week INT, 
+    month INT, 
+    year INT, 
+    weekday INT);
+""")
+
+# CREATE INDEXES
+
+# matches the predicate of song_select
+song_title_duration_index_create = ("""
+CREATE INDEX IF NOT EXISTS songs_title_duration_idx 
+ON songs (title, duration);
+""")
+
+artist_name_index_create = ("""
+CREATE INDEX IF NOT EXISTS artists_name_idx 
+ON artists (name);
+""")
+
+# matches the predicate of songplay_events_delete and songplay_stage_delete
+songplay_event_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_event_idx 
+ON songplays (start_time, user_id, session_id);
+""")
+
+# ADD CONSTRAINTS (REBUILD)
+
+constraint_exists = ("""
+SELECT count(*) 
+FROM pg_constraint 
+WHERE conname = %s
+""")
+
+# rows that share or lack a key, deleted except the first row of each key in {order} before the key is added
+primary_key_violations = ("""
+SELECT count(*) - count(DISTINCT {column}) 
+FROM {table}
+""")
+
+primary_key_dedupe = ("""
+DELETE FROM {table} 
+WHERE {column} IS NULL 
+OR ctid IN (
+    SELECT ctid 
+    FROM (
+        SELECT ctid, row_number() OVER (PARTITION BY {column} ORDER BY {order}) AS n 
+        FROM {table}) r 
+    WHERE r.n > 1)
+""")
+
+primary_key_add = ("""
+ALTER TABLE {table} 
+ADD CONSTRAINT {table}_pkey PRIMARY KEY ({column})
+""")
+
+# rows referencing a missing key, kept and the key added NOT VALID so it is enforced for new rows only
+foreign_key_violations = ("""
+SELECT count(*) 
+FROM {table} c 
+WHERE c.{column} IS NOT NULL 
+AND NOT EXISTS (
+    SELECT 1 
+    FROM {ref_table} p 
+    WHERE p.{ref_column} = c.{column})
+""")
+
+foreign_key_add = ("""
+ALTER TABLE {table} 
+ADD CONSTRAINT {table}_{column}_fkey FOREIGN KEY ({column}) 
+REFERENCES {ref_table} ({ref_column}) {not_valid}
+""")
+
 # INSERT RECORDS
 
 songplay_table_insert = ("""
@@ -72,14 +203,14 @@ ON CONFLICT
 DO NOTHING;
 """)
 
-user_table_insert = ("""
-INSERT INTO users 
-    (user_id, first_name, last_name, gender, level)
-VALUES
-    (%s,%s,%s,%s,%s)
-ON CONFLICT (user_id)
-DO UPDATE
-SET level = EXCLUDED.level;
+# DELETE SONGPLAYS OF EVENTS LOADED BEFORE, SO A CHANGED FILE REPLACES ITS EARLIER ROWS
+
+songplay_events_delete = ("""
+DELETE FROM songplays p 
+USING unnest(%s::TIMESTAMP[], %s::INT[], %s::INT[]) AS k (start_time, user_id, session_id) 
+WHERE p.start_time = k.start_time 
+AND p.user_id = k.user_id 
+AND p.session_id = k.session_id
 """)
 
 song_table_insert = ("""
@@ -100,15 +231,174 @@ ON CONFLICT
 DO NOTHING;
 """)
 
-time_table_insert = ("""
+time_table_insert_values = ("""
 INSERT INTO time 
     (start_time, hour, day, week, month, year, weekday)
+VALUES %s
+ON CONFLICT
+DO NOTHING;
+""")
+
+load_manifest_upsert = ("""
+INSERT INTO load_manifest 
+    (path, size, mtime, content_hash)
 VALUES
-    (%s,%s,%s,%s,%s,%s,%s)
+    (%s,%s,%s,%s)
+ON CONFLICT (path)
+DO UPDATE
+SET size = EXCLUDED.size, 
+    mtime = EXCLUDED.mtime, 
+    content_hash = EXCLUDED.content_hash, 
+    loaded_at = now();
+""")
+
+user_table_insert_values = ("""
+INSERT INTO users 
+    (user_id, first_name, last_name, gender, level, last_seen)
+VALUES %s
+ON CONFLICT (user_id)
+DO UPDATE
+SET level = EXCLUDED.level, 
+    last_seen = EXCLUDED.last_seen
+WHERE users.last_seen IS NULL 
+OR users.last_seen < EXCLUDED.last_seen;
+""")
+
+# BULK LOAD (COPY FROM STDIN INTO TEMP STAGING TABLES)
+
+copy_from_stdin = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+
+songplay_stage_create = ("""
+CREATE TEMP TABLE songplays_stage (
+    start_time TIMESTAMP, 
+    user_id INT, 
+    level VARCHAR, 
+    song VARCHAR, 
+    artist VARCHAR, 
+    length NUMERIC, 
+    session_id INT, 
+    location VARCHAR, 
+    user_agent VARCHAR)
+ON COMMIT DROP;
+""")
+
+user_stage_create = ("""
+CREATE TEMP TABLE users_stage (LIKE users)
+ON COMMIT DROP;
+""")
+
+song_stage_create = ("""
+CREATE TEMP TABLE songs_stage (LIKE songs)
+ON COMMIT DROP;
+""")
+
+artist_stage_create = ("""
+CREATE TEMP TABLE artists_stage (LIKE artists)
+ON COMMIT DROP;
+""")
+
+time_stage_create = ("""
+CREATE TEMP TABLE time_stage (LIKE time)
+ON COMMIT DROP;
+""")
+
+# MERGE STAGED RECORDS
+
+songplay_stage_delete = ("""
+DELETE FROM songplays p 
+USING songplays_stage e 
+WHERE p.start_time = e.start_time 
+AND p.user_id = e.user_id 
+AND p.session_id = e.session_id;
+""")
+
+songplay_table_merge = ("""
+INSERT INTO songplays 
+    (start_time, user_id, level, song_id, 
+     artist_id, session_id, location, user_agent)
+SELECT e.start_time, e.user_id, e.level, m.song_id, 
+       m.artist_id, e.session_id, e.location, e.user_agent
+FROM songplays_stage e
+LEFT JOIN LATERAL (
+    SELECT s.song_id, a.artist_id 
+    FROM songs s 
+    INNER JOIN artists a 
+    ON (s.artist_id = a.artist_id) 
+    WHERE s.title = e.song 
+    AND a.name = e.artist 
+    AND s.duration = e.length
+    LIMIT 1) m ON TRUE
+ON CONFLICT
+DO NOTHING;
+""")
+
+user_table_merge = ("""
+INSERT INTO users 
+    (user_id, first_name, last_name, gender, level, last_seen)
+SELECT user_id, first_name, last_name, gender, level, last_seen
+FROM users_stage
+ORDER BY user_id
+ON CONFLICT (user_id)
+DO UPDATE
+SET level = EXCLUDED.level, 
+    last_seen = EXCLUDED.last_seen
+WHERE users.last_seen IS NULL 
+OR users.last_seen < EXCLUDED.last_seen;
+""")
+
+song_table_merge = ("""
+INSERT INTO songs 
+    (song_id, title, artist_id, year, duration)
+SELECT song_id, title, artist_id, year, duration
+FROM songs_stage
+ON CONFLICT
+DO NOTHING;
+""")
+
+artist_table_merge = ("""
+INSERT INTO artists 
+    (artist_id, name, location, latitude, longitude)
+SELECT artist_id, name, location, latitude, longitude
+FROM artists_stage
 ON CONFLICT
 DO NOTHING;
 """)
 
+time_table_merge = ("""
+INSERT INTO time 
+    (start_time, hour, day, week, month, year, weekday)
+SELECT start_time, hour, day, week, month, year, weekday
+FROM time_stage
+ON CONFLICT
+DO NOTHING;
+""")
+
+# MERGE STAGED RECORDS INTO TABLES WITHOUT CONSTRAINTS (REBUILD)
+
+songplay_table_rebuild_merge = ("""
+INSERT INTO songplays 
+    (start_time, user_id, level, song_id, 
+     artist_id, session_id, location, user_agent)
+SELECT e.start_time, e.user_id, e.level, m.song_id, 
+       m.artist_id, e.session_id, e.location, e.user_agent
+FROM songplays_stage e
+LEFT JOIN (
+    SELECT DISTINCT ON (s.title, a.name, s.duration) 
+           s.title, a.name, s.duration, s.song_id, a.artist_id 
+    FROM songs s 
+    INNER JOIN artists a 
+    ON (s.artist_id = a.artist_id) 
+    ORDER BY s.title, a.name, s.duration, s.song_id) m 
+ON (m.title = e.song AND m.name = e.artist AND m.duration = e.length);
+""")
+
+user_table_rebuild_merge = ("""
+INSERT INTO users 
+    (user_id, first_name, last_name, gender, level, last_seen)
+SELECT user_id, first_name, last_name, gender, level, last_seen
+FROM users_stage;
+""")
+
 # FIND SONGS
 
 song_select = ("""
@@ -121,7 +411,73 @@ AND a.name = %s
 AND s.duration = %s
 """)
 
+# LOAD MANIFEST
+
+load_manifest_select = ("""
+SELECT path, size, mtime, content_hash 
+FROM load_manifest
+""")
+
+# TIME DIMENSION
+
+time_keys_select = ("""
+SELECT start_time 
+FROM time 
+WHERE start_time BETWEEN %s AND %s
+""")
+
+# SONG LOOKUP INDEX
+
+song_lookup_select = ("""
+SELECT s.title, a.name, s.duration, s.song_id, a.artist_id 
+FROM songs s 
+INNER JOIN artists a 
+ON (s.artist_id = a.artist_id)
+""")
+
+song_lookup_keys_select = ("""
+SELECT s.title, a.name, s.duration, s.song_id, a.artist_id 
+FROM songs s 
+INNER JOIN artists a 
+ON (s.artist_id = a.artist_id) 
+INNER JOIN unnest(%s::VARCHAR[], %s::VARCHAR[], %s::NUMERIC[]) AS k (title, name, duration) 
+ON (s.title = k.title AND a.name = k.name AND s.duration = k.duration)
+""")
+
 # QUERY LISTS
 
-create_table_queries = [user_table_create, artist_table_create, time_table_create, song_table_create, songplay_table_create]
-drop_table_queries = [user_table_drop, artist_table_drop, time_table_drop, song_table_drop, songplay_table_drop]
\ No newline at end of file
+create_table_queries = [user_table_create, artist_table_create, time_table_create, song_table_create, songplay_table_create, load_manifest_table_create]
+create_index_queries = [song_title_duration_index_create, artist_name_index_create, songplay_event_index_create]
+drop_table_queries = [user_table_drop, artist_table_drop, time_table_drop, song_table_drop, songplay_table_drop, load_manifest_table_drop]
+
+# BULK LOAD STAGES: table -> (staging table, staging create, merge statement or statements)
+
+bulk_load_queries = {
+    'songs': ('songs_stage', song_stage_create, song_table_merge),
+    'artists': ('artists_stage', artist_stage_create, artist_table_merge),
+    'time': ('time_stage', time_stage_create, time_table_merge),
+    'users': ('users_stage', user_stage_create, user_table_merge),
+    'songplays': ('songplays_stage', songplay_stage_create, [songplay_stage_delete, songplay_table_merge]),
+}
+
+# REBUILD: tables created without constraints, loaded with the bulk stages and constrained at the end
+
+rebuild_create_table_queries = [user_table_create_unconstrained, artist_table_create_unconstrained, time_table_create_unconstrained, song_table_create_unconstrained, songplay_table_create_unconstrained, load_manifest_table_create]
+
+rebuild_load_queries = dict(bulk_load_queries,
+    users=('users_stage', user_stage_create, user_table_rebuild_merge),
+    songplays=('songplays_stage', songplay_stage_create, [songplay_stage_delete, songplay_table_rebuild_merge]))
+
+# (table, column)
+rebuild_primary_keys = [('users', 'user_id'), ('artists', 'artist_id'), ('time', 'start_time'), ('songs', 'song_id'), ('songplays', 'songplay_id')]
+
+# table -> order of the rows sharing a key, the first one is kept, rows are kept in load order by default
+rebuild_primary_key_order = {'users': 'last_seen DESC NULLS LAST, ctid'}
+
+# (table, column, referenced table, referenced column)
+rebuild_foreign_keys = [
+    ('songplays', 'start_time', 'time', 'start_time'),
+    ('songplays', 'user_id', 'users', 'user_id'),
+    ('songplays', 'song_id', 'songs', 'song_id'),
+    ('songplays', 'artist_id', 'artists', 'artist_id'),
+]
\ No newline at end of file
@@ -0,0 +1,78 @@
+import json
+import argparse
+from datetime import datetime
+
+from cassandra.cluster import Cluster
+from cql_queries import keyspace_create, create_table_queries
+from events import stream_events
+from loader import load_events
+
+
+def run_benchmark(session, source, concurrency, batch_size, max_buffered):
+    """Truncates the tables and loads the events, one row per request or in partition batches
+    Args:
+        session (`cassandra.cluster.Session`): session connected to the keyspace
+        source (str): directory of raw *events.csv files, or an event data csv file
+        concurrency (int): maximum number of requests in flight
+        batch_size (int): maximum number of rows in a partition batch, None for one row per request
+        max_buffered (int): maximum number of rows held in partitions waiting to be batched
+    Returns:
+        dict: benchmark result
+    """
+    for table in ('session_songs', 'user_sessions', 'song_users'):
+        session.execute('TRUNCATE {}'.format(table))
+
+    report = load_events(session, stream_events(source), concurrency=concurrency,
+                         batch_size=batch_size, max_buffered=max_buffered)
+    written = sum(report['written'].values())
+
+    return {
+        'run_at': datetime.now().isoformat(timespec='seconds'),
+        'source': source,
+        'concurrency': concurrency,
+        'batch_size': batch_size,
+        'rows': report['rows'],
+        'written': written,
+        'requests': sum(report['requests'].values()),
+        'errors': sum(report['errors'].values()),
+        'seconds': round(report['seconds'], 3),
+        'rows_per_second': round(written / report['seconds'], 1) if report['seconds'] else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares one row per request with partition batches against a local single node Cassandra')
+    parser.add_argument('--source', default='event_data',
+                        help='directory of raw *events.csv files, or an event data csv file')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'], help='contact points of the cluster')
+    parser.add_argument('--concurrency', type=int, default=100, help='maximum number of requests in flight')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[10, 50, 200],
+                        help='batch sizes compared with one row per request')
+    parser.add_argument('--max-buffered', type=int, default=10000,
+                        help='maximum number of rows held in partitions waiting to be batched')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='file the results are appended to as json lines')
+    args = parser.parse_args()
+
+    cluster = Cluster(args.hosts)
+    session = cluster.connect()
+    session.execute(keyspace_create)
+    session.set_keyspace('sparkify')
+    for query in create_table_queries:
+        session.execute(query)
+
+    print('{:>10} {:>9} {:>9} {:>7} {:>8} {:>10}'.format('batch size', 'rows', 'requests', 'errors', 'seconds', 'rows/s'))
+    with open(args.results, 'a') as f:
+        for batch_size in [None] + args.batch_sizes:
+            result = run_benchmark(session, args.source, args.concurrency, batch_size, args.max_buffered)
+            f.write(json.dumps(result) + '\n')
+            print('{:>10} {:>9} {:>9} {:>7} {:>8.2f} {:>10}'.format(
+                batch_size or 'row', result['written'], result['requests'], result['errors'],
+                result['seconds'], result['rows_per_second']))
+
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
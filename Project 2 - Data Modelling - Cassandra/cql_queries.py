@@ -0,0 +1,146 @@
+# KEYSPACE
+
+keyspace_create = ("""
+CREATE KEYSPACE IF NOT EXISTS sparkify
+WITH REPLICATION =
+{ 'class' : 'SimpleStrategy', 'replication_factor' : 1 }
+""")
+
+# DROP TABLES
+
+session_songs_table_drop = "DROP TABLE IF EXISTS session_songs"
+user_sessions_table_drop = "DROP TABLE IF EXISTS user_sessions"
+song_users_table_drop = "DROP TABLE IF EXISTS song_users"
+load_manifest_table_drop = "DROP TABLE IF EXISTS load_manifest"
+
+# CREATE TABLES
+
+# Query 1: artist, song title and song's length heard during a given session_id and session_item_id
+session_songs_table_create = ("""
+CREATE TABLE IF NOT EXISTS session_songs (
+    session_id INT,
+    session_item_id INT,
+    artist VARCHAR,
+    song_title VARCHAR,
+    song_length DOUBLE,
+    PRIMARY KEY (session_id, session_item_id))
+""")
+
+# Query 2: artist, song sorted by session_item_id and user name for a given user_id and session_id
+user_sessions_table_create = ("""
+CREATE TABLE IF NOT EXISTS user_sessions (
+    user_id INT,
+    session_id INT,
+    session_item_id INT,
+    artist VARCHAR,
+    first_name VARCHAR,
+    last_name VARCHAR,
+    song_title VARCHAR,
+    PRIMARY KEY ((user_id, session_id), session_item_id))
+""")
+
+# Query 3: every user name who listened to a given song_title
+song_users_table_create = ("""
+CREATE TABLE IF NOT EXISTS song_users (
+    song_title VARCHAR,
+    user_id INT,
+    first_name VARCHAR,
+    last_name VARCHAR,
+    PRIMARY KEY (song_title, user_id))
+""")
+
+# event files loaded into the tables above, so a rerun resumes after the last loaded file
+load_manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_manifest (
+    path VARCHAR,
+    size BIGINT,
+    mtime DOUBLE,
+    rows INT,
+    loaded_at TIMESTAMP,
+    PRIMARY KEY (path))
+""")
+
+# INSERT RECORDS
+
+session_songs_insert = ("""
+INSERT INTO session_songs (session_id, session_item_id, artist, song_title, song_length)
+VALUES (?, ?, ?, ?, ?)
+""")
+
+user_sessions_insert = ("""
+INSERT INTO user_sessions (user_id, session_id, session_item_id, artist, first_name, last_name, song_title)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+""")
+
+song_users_insert = ("""
+INSERT INTO song_users (song_title, user_id, first_name, last_name)
+VALUES (?, ?, ?, ?)
+""")
+
+load_manifest_insert = ("""
+INSERT INTO load_manifest (path, size, mtime, rows, loaded_at)
+VALUES (?, ?, ?, ?, toTimestamp(now()))
+""")
+
+# QUERIES
+
+session_songs_select = ("""
+SELECT artist, song_title, song_length
+FROM session_songs
+WHERE session_id = ? AND session_item_id = ?
+""")
+
+user_sessions_select = ("""
+SELECT artist, song_title, first_name, last_name
+FROM user_sessions
+WHERE user_id = ? AND session_id = ?
+""")
+
+song_users_select = ("""
+SELECT first_name, last_name
+FROM song_users
+WHERE song_title = ?
+""")
+
+load_manifest_select = ("""
+SELECT path, size, mtime
+FROM load_manifest
+""")
+
+# QUERY LISTS
+
+create_table_queries = [session_songs_table_create, user_sessions_table_create, song_users_table_create, load_manifest_table_create]
+drop_table_queries = [session_songs_table_drop, user_sessions_table_drop, song_users_table_drop, load_manifest_table_drop]
+
+# table -> (column, csv header, CQL type) of each value of its insert statement, in order
+table_columns = {
+    'session_songs': [
+        ('session_id', 'sessionId', 'INT'),
+        ('session_item_id', 'itemInSession', 'INT'),
+        ('artist', 'artist', 'VARCHAR'),
+        ('song_title', 'song', 'VARCHAR'),
+        ('song_length', 'length', 'DOUBLE'),
+    ],
+    'user_sessions': [
+        ('user_id', 'userId', 'INT'),
+        ('session_id', 'sessionId', 'INT'),
+        ('session_item_id', 'itemInSession', 'INT'),
+        ('artist', 'artist', 'VARCHAR'),
+        ('first_name', 'firstName', 'VARCHAR'),
+        ('last_name', 'lastName', 'VARCHAR'),
+        ('song_title', 'song', 'VARCHAR'),
+    ],
+    'song_users': [
+        ('song_title', 'song', 'VARCHAR'),
+        ('user_id', 'userId', 'INT'),
+        ('first_name', 'firstName', 'VARCHAR'),
+        ('last_name', 'lastName', 'VARCHAR'),
+    ],
+}
+
+# table -> insert statement
+insert_queries = {
+    'session_songs': session_songs_insert,
+    'user_sessions': user_sessions_insert,
+    'song_users': song_users_insert,
+}
@@ -0,0 +1,171 @@
+import os
+import csv
+import time
+import argparse
+from datetime import date
+
+from cassandra import ConsistencyLevel
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cql_queries import (keyspace_create, create_table_queries, drop_table_queries,
+                         load_manifest_insert, load_manifest_select)
+from events import EVENT_COLUMNS, get_event_files, read_event_files, write_event_rows
+from loader import (ConcurrentWriter, PartitionBatcher, Quarantine, prepare_inserts, write_rows, build_report,
+                    print_load_report)
+
+
+def connect(hosts, consistency):
+    """Connects to the cluster with the consistency level of all statements
+    Args:
+        hosts (list): contact points of the cluster
+        consistency (str): name of a `cassandra.ConsistencyLevel`, e.g. LOCAL_QUORUM
+    Returns:
+        tuple: `cassandra.cluster.Cluster` and its `cassandra.cluster.Session`
+    """
+    profile = ExecutionProfile(consistency_level=ConsistencyLevel.name_to_value[consistency])
+    cluster = Cluster(hosts, execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    return cluster, cluster.connect()
+
+
+def create_tables(session, reset=False):
+    """Creates the keyspace and the tables, dropping the tables and the load manifest first with reset
+    Args:
+        session (`cassandra.cluster.Session`): session to the cluster
+        reset (bool): drops the tables first, so every file is loaded again
+    Returns:
+        None
+    """
+    session.execute(keyspace_create)
+    session.set_keyspace('sparkify')
+    if reset:
+        for query in drop_table_queries:
+            session.execute(query)
+    for query in create_table_queries:
+        session.execute(query)
+
+
+def get_new_files(session, file_path_list):
+    """Selects the files that are not in the load manifest, or have changed since they were loaded
+    Args:
+        session (`cassandra.cluster.Session`): session connected to the keyspace
+        file_path_list (list): filepaths of raw event files
+    Returns:
+        list: (path, size, mtime) of the files to be loaded
+    """
+    loaded = {row.path: (row.size, row.mtime) for row in session.execute(load_manifest_select)}
+
+    new_files = []
+    for f in file_path_list:
+        stat = os.stat(f)
+        if loaded.get(f) != (stat.st_size, stat.st_mtime):
+            new_files.append((f, stat.st_size, stat.st_mtime))
+    return new_files
+
+
+def load_files(session, new_files, concurrency=100, batch_size=None, max_buffered=10000, datafile=None,
+               quarantine=None, chunksize=10000):
+    """Loads event files one after the other, recording each file in the load manifest once
+    all its rows are written. Files with write errors are not recorded and are loaded again
+    by the next run, rewriting rows is harmless since inserts overwrite the same primary keys.
+    Rows rejected by parsing are quarantined and do not keep their file from being recorded.
+    Args:
+        session (`cassandra.cluster.Session`): session connected to the keyspace
+        new_files (list): (path, size, mtime) of the files to be loaded
+        concurrency (int): maximum number of requests in flight
+        batch_size (int): maximum number of rows in a partition batch, rows are written
+            one by one if None
+        max_buffered (int): maximum number of rows held in partitions waiting to be batched
+        datafile (str): filepath of an event data csv file written from the loaded rows, if set
+        quarantine (`loader.Quarantine`): file collecting the rows rejected by parsing, they
+            are counted as errors if None
+        chunksize (int): number of rows read and parsed at a time
+    Returns:
+        dict: load report, see `loader.build_report`
+    """
+    statements = prepare_inserts(session)
+    manifest_insert = session.prepare(load_manifest_insert)
+    writer = ConcurrentWriter(session, concurrency)
+    batcher = PartitionBatcher(writer, batch_size, max_buffered) if batch_size else None
+
+    csvfile = open(datafile, 'w', encoding='utf8', newline='') if datafile else None
+    if csvfile:
+        csvwriter = csv.writer(csvfile, dialect='myDialect')
+        csvwriter.writerow(EVENT_COLUMNS)
+
+    start = time.time()
+    total = 0
+    for i, (path, size, mtime) in enumerate(new_files, 1):
+        file_start = time.time()
+        errors = sum(writer.errors.values())
+
+        chunks = read_event_files([path], chunksize)
+        if csvfile:
+            chunks = write_event_rows(chunks, csvwriter)
+        count = write_rows(chunks, statements, writer, batcher, quarantine)
+        if batcher:
+            batcher.flush()
+        writer.wait()
+        total += count
+
+        errors = sum(writer.errors.values()) - errors
+        if errors:
+            print('{}/{} {}: {} rows, {} errors, not recorded'.format(i, len(new_files), path, count, errors))
+        else:
+            session.execute(manifest_insert, (path, size, mtime, count))
+            print('{}/{} {}: {} rows in {:.2f}s'.format(i, len(new_files), path, count, time.time() - file_start))
+
+    if csvfile:
+        csvfile.close()
+
+    return build_report(writer, total, time.time() - start, quarantine)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Creates the sparkify keyspace and tables, and loads the event files of a date range. '
+                    'Each loaded file is recorded, so a rerun resumes with the files not loaded yet.')
+    parser.add_argument('--source', default='event_data', help='directory of raw *events.csv files')
+    parser.add_argument('--start-date', type=date.fromisoformat, help='first date loaded, YYYY-MM-DD')
+    parser.add_argument('--end-date', type=date.fromisoformat, help='last date loaded, YYYY-MM-DD')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'], help='contact points of the cluster')
+    parser.add_argument('--consistency', type=str.upper, default='LOCAL_ONE',
+                        choices=sorted(ConsistencyLevel.name_to_value),
+                        help='consistency level of the writes')
+    parser.add_argument('--concurrency', type=int, default=100, help='maximum number of requests in flight')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='groups rows by partition key into unlogged batches of at most this many rows, '
+                             'rows are written one by one if not set')
+    parser.add_argument('--max-buffered', type=int, default=10000,
+                        help='maximum number of rows held in partitions waiting to be batched')
+    parser.add_argument('--reload', action='store_true',
+                        help='loads every file of the date range, including the ones already loaded')
+    parser.add_argument('--reset', action='store_true',
+                        help='drops the tables and the load manifest before loading')
+    parser.add_argument('--write-datafile', metavar='PATH',
+                        help='also writes the loaded rows to an event data csv file, in the same pass')
+    parser.add_argument('--quarantine', default='quarantine.csv',
+                        help='csv file the rows with values not matching the column types are appended to, '
+                             'overwritten with --reset or --reload')
+    parser.add_argument('--chunksize', type=int, default=10000, help='number of rows read and parsed at a time')
+    args = parser.parse_args()
+
+    cluster, session = connect(args.hosts, args.consistency)
+    create_tables(session, reset=args.reset)
+
+    file_path_list = get_event_files(args.source, args.start_date, args.end_date)
+    if args.reload:
+        new_files = [(f, os.stat(f).st_size, os.stat(f).st_mtime) for f in file_path_list]
+    else:
+        new_files = get_new_files(session, file_path_list)
+    print('{} files found in {}, {} to be loaded'.format(len(file_path_list), args.source, len(new_files)))
+
+    quarantine = Quarantine(args.quarantine, overwrite=args.reset or args.reload)
+    print_load_report(load_files(session, new_files, concurrency=args.concurrency, batch_size=args.batch_size,
+                                 max_buffered=args.max_buffered, datafile=args.write_datafile,
+                                 quarantine=quarantine, chunksize=args.chunksize))
+    quarantine.close()
+
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import csv
+import glob
+from datetime import date
+
+import pandas as pd
+
+
+# columns of event_datafile_new.csv
+EVENT_COLUMNS = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                 'level', 'location', 'sessionId', 'song', 'userId']
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def file_date(filepath):
+    """Parses the date of a raw event file named like 2018-11-01-events.csv
+    Args:
+        filepath (str): filepath of the event file
+    Returns:
+        `datetime.date`: date of the events in the file
+    """
+    return date.fromisoformat(os.path.basename(filepath)[:10])
+
+
+def get_event_files(filepath, start_date=None, end_date=None):
+    """Collects the raw event files under given path in date order
+    Args:
+        filepath (str): directory of *events.csv files
+        start_date (`datetime.date`): first date of the files collected, if set
+        end_date (`datetime.date`): last date of the files collected, if set
+    Returns:
+        list: filepaths of the event files
+    """
+    file_path_list = []
+    for root, dirs, files in os.walk(filepath):
+        file_path_list += glob.glob(os.path.join(root, '*events.csv'))
+
+    if start_date:
+        file_path_list = [f for f in file_path_list if file_date(f) >= start_date]
+    if end_date:
+        file_path_list = [f for f in file_path_list if file_date(f) <= end_date]
+    return sorted(file_path_list)
+
+
+def read_event_chunks(filepath, chunksize=10000):
+    """Streams the song plays of a raw event file or an event data csv file in chunks,
+    rows without an artist are not song plays and are skipped. Values are kept as
+    strings, they are parsed per table by `loader.parse_chunk`.
+    Args:
+        filepath (str): filepath of csv file with a header holding EVENT_COLUMNS
+        chunksize (int): number of rows read at a time
+    Yields:
+        `pandas.DataFrame`: EVENT_COLUMNS of the rows
+    """
+    chunks = pd.read_csv(filepath, usecols=EVENT_COLUMNS, dtype=str, keep_default_na=False,
+                         encoding='utf8', chunksize=chunksize)
+    for df in chunks:
+        df = df[df['artist'] != '']
+        if len(df):
+            yield df[EVENT_COLUMNS]
+
+
+def read_event_files(file_path_list, chunksize=10000):
+    """Streams the song plays of raw event files in chunks
+    Args:
+        file_path_list (list): filepaths of raw event files
+        chunksize (int): number of rows read at a time
+    Yields:
+        `pandas.DataFrame`: EVENT_COLUMNS of the rows
+    """
+    for f in file_path_list:
+        yield from read_event_chunks(f, chunksize)
+
+
+def write_event_rows(chunks, writer):
+    """Writes chunks with a csv writer as they are passed on
+    Args:
+        chunks (iterable): `pandas.DataFrame` chunks with EVENT_COLUMNS
+        writer (`csv.writer`): writer of an event data csv file with its header written
+    Yields:
+        `pandas.DataFrame`: the chunks, unchanged
+    """
+    for df in chunks:
+        writer.writerows(df.itertuples(index=False, name=None))
+        yield df
+
+
+def write_event_datafile(chunks, filepath):
+    """Writes chunks to an event data csv file as they are passed on, so the file is
+    produced in the same pass as the load
+    Args:
+        chunks (iterable): `pandas.DataFrame` chunks with EVENT_COLUMNS
+        filepath (str): filepath of the csv file to write
+    Yields:
+        `pandas.DataFrame`: the chunks, unchanged
+    """
+    with open(filepath, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(EVENT_COLUMNS)
+        yield from write_event_rows(chunks, writer)
+
+
+def stream_events(source, datafile=None, chunksize=10000):
+    """Streams the rows to be loaded from raw event files or an event data csv file
+    Args:
+        source (str): directory of raw *events.csv files, or an event data csv file
+        datafile (str): filepath of an event data csv file written from the rows, if set
+        chunksize (int): number of rows read at a time
+    Returns:
+        iterator: `pandas.DataFrame` chunks with EVENT_COLUMNS
+    """
+    if os.path.isdir(source):
+        chunks = read_event_files(get_event_files(source), chunksize)
+    else:
+        chunks = read_event_chunks(source, chunksize)
+
+    if datafile:
+        chunks = write_event_datafile(chunks, datafile)
+    return chunks
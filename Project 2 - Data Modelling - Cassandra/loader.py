@@ -0,0 +1,393 @@
+import csv
+import time
+import threading
+from collections import Counter, OrderedDict
+
+import pandas as pd
+from cassandra.query import BatchStatement, BatchType
+from cql_queries import insert_queries, table_columns
+from events import EVENT_COLUMNS
+
+
+# table -> number of leading insert values making up its partition key
+PARTITION_KEYS = {
+    'session_songs': 1,
+    'user_sessions': 2,
+    'song_users': 1,
+}
+
+
+def parse_int(values):
+    """Parses strings into 32 bit integers
+    Args:
+        values (`pandas.Series`): strings
+    Returns:
+        tuple: `pandas.Series` of parsed values and boolean `pandas.Series` of the valid ones
+    """
+    parsed = pd.to_numeric(values, errors='coerce')
+    valid = parsed.notnull() & (parsed % 1 == 0) & parsed.between(-2**31, 2**31 - 1)
+    return parsed.where(valid, 0).astype('int64'), valid
+
+
+def parse_double(values):
+    """Parses strings into floats
+    Args:
+        values (`pandas.Series`): strings
+    Returns:
+        tuple: `pandas.Series` of parsed values and boolean `pandas.Series` of the valid ones
+    """
+    parsed = pd.to_numeric(values, errors='coerce').astype('float64')
+    return parsed, parsed.notnull()
+
+
+def parse_varchar(values):
+    """Keeps strings as they are
+    Args:
+        values (`pandas.Series`): strings
+    Returns:
+        tuple: `pandas.Series` of values and boolean `pandas.Series` of the valid ones
+    """
+    return values, pd.Series(True, index=values.index)
+
+
+# CQL type -> parser of a column of strings
+CQL_PARSERS = {
+    'INT': parse_int,
+    'DOUBLE': parse_double,
+    'VARCHAR': parse_varchar,
+}
+
+
+def parse_chunk(df, table):
+    """Parses a chunk of event rows into the insert values of a table, one column at a time.
+    Rows with a value that does not parse to the CQL type of its column, or with an empty
+    partition key, are rejected.
+    Args:
+        df (`pandas.DataFrame`): chunk with `events.EVENT_COLUMNS` as strings
+        table (str): table name, key of `cql_queries.table_columns`
+    Returns:
+        tuple: list of insert values of the valid rows, rejected rows with EVENT_COLUMNS and
+            `pandas.Series` naming the invalid columns of each rejected row
+    """
+    columns = []
+    valid = pd.Series(True, index=df.index)
+    reasons = pd.Series('', index=df.index)
+    for i, (column, header, cql_type) in enumerate(table_columns[table]):
+        values, column_valid = CQL_PARSERS[cql_type](df[header])
+        if i < PARTITION_KEYS[table]:
+            column_valid &= df[header] != ''
+        reasons = reasons.where(column_valid, reasons + 'invalid {} {}; '.format(column, cql_type))
+        valid &= column_valid
+        columns.append(values)
+
+    rows = list(zip(*[values[valid].tolist() for values in columns]))
+    return rows, df.loc[~valid, EVENT_COLUMNS], reasons[~valid].str.rstrip('; ')
+
+
+class Quarantine:
+    """Csv file collecting the rows rejected by `parse_chunk`, with the table they were meant
+    for and the reason, opened on the first rejected row. Rows are appended to the ones of
+    earlier runs, whose files a resumed run skips.
+    """
+
+    def __init__(self, filepath, overwrite=False):
+        """Initializes the quarantine
+        Args:
+            filepath (str): filepath of the csv file
+            overwrite (bool): overwrites the rows of earlier runs on the first rejected row
+        """
+        self.filepath = filepath
+        self.overwrite = overwrite
+        self.rows = Counter()
+        self._file = None
+        self._writer = None
+
+    def add(self, table, df, reasons):
+        """Writes rejected rows
+        Args:
+            table (str): table the rows were meant for
+            df (`pandas.DataFrame`): rejected rows with `events.EVENT_COLUMNS`
+            reasons (`pandas.Series`): reason of each rejected row
+        Returns:
+            None
+        """
+        if not len(df):
+            return
+        if self._file is None:
+            self._file = open(self.filepath, 'w' if self.overwrite else 'a', encoding='utf8', newline='')
+            self._writer = csv.writer(self._file, dialect='myDialect')
+            if self._file.tell() == 0:
+                self._writer.writerow(['table', 'reason'] + EVENT_COLUMNS)
+        for reason, row in zip(reasons, df.itertuples(index=False, name=None)):
+            self._writer.writerow((table, reason) + row)
+        self.rows[table] += len(df)
+
+    def close(self):
+        """Closes the csv file
+        Returns:
+            None
+        """
+        if self._file is not None:
+            self._file.close()
+
+
+class ConcurrentWriter:
+    """Executes prepared statements with `execute_async`, keeping at most `concurrency`
+    requests in flight. Written rows, requests and errors are counted per table instead of
+    printing every exception, with the first few error messages kept as samples.
+    """
+
+    def __init__(self, session, concurrency=100, max_error_samples=5):
+        """Initializes the writer
+        Args:
+            session (`cassandra.cluster.Session`): session connected to the keyspace
+            concurrency (int): maximum number of requests in flight
+            max_error_samples (int): number of error messages kept
+        """
+        self.session = session
+        self.concurrency = concurrency
+        self.max_error_samples = max_error_samples
+        self.written = Counter()
+        self.requests = Counter()
+        self.errors = Counter()
+        self.error_samples = []
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def submit(self, table, statement, values=None, rows=1):
+        """Sends a statement once fewer than `concurrency` requests are in flight
+        Args:
+            table (str): table the statement writes to
+            statement (`cassandra.query.Statement`): prepared insert statement or batch
+            values (tuple): values bound to a prepared statement, None for a batch
+            rows (int): number of rows written by the statement
+        Returns:
+            None
+        """
+        with self._condition:
+            while self._in_flight >= self.concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+            self.requests[table] += 1
+
+        try:
+            future = self.session.execute_async(statement, values)
+        except Exception as e:
+            self._failed(e, table, rows)
+            return
+        future.add_callbacks(self._done, self._failed, callback_args=(table, rows), errback_args=(table, rows))
+
+    def reject(self, table, error):
+        """Counts a row that could not be turned into the values of a statement
+        Args:
+            table (str): table the row was meant for
+            error (Exception): error raised while building the values
+        Returns:
+            None
+        """
+        with self._condition:
+            self._add_error(table, error, 1)
+
+    def wait(self):
+        """Blocks until every submitted request has completed
+        Returns:
+            None
+        """
+        with self._condition:
+            while self._in_flight:
+                self._condition.wait()
+
+    def _add_error(self, table, error, rows):
+        self.errors[table] += rows
+        if len(self.error_samples) < self.max_error_samples:
+            self.error_samples.append('{}: {}'.format(table, error))
+
+    def _done(self, result, table, rows):
+        with self._condition:
+            self.written[table] += rows
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def _failed(self, error, table, rows):
+        with self._condition:
+            self._add_error(table, error, rows)
+            self._in_flight -= 1
+            self._condition.notify()
+
+
+class PartitionBatcher:
+    """Groups the rows of each table by partition key and sends them to a `ConcurrentWriter`
+    as unlogged batches holding a single partition each, so a batch is applied by the
+    replicas of one partition in one request instead of one request per row.
+
+    A partition is sent once it holds `batch_size` rows. At most `max_buffered` rows are
+    held in total, past which the partition buffered the longest is sent, so memory stays
+    bounded on long streams of events.
+    """
+
+    def __init__(self, writer, batch_size=50, max_buffered=10000):
+        """Initializes the batcher
+        Args:
+            writer (`ConcurrentWriter`): writer sending the batches
+            batch_size (int): maximum number of rows in a batch
+            max_buffered (int): maximum number of rows held across all partitions
+        """
+        self.writer = writer
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self._partitions = OrderedDict()
+        self._buffered = 0
+
+    def add(self, table, statement, values):
+        """Buffers a row in the partition it belongs to
+        Args:
+            table (str): table the row is written to
+            statement (`cassandra.query.PreparedStatement`): prepared insert statement
+            values (tuple): values bound to the statement
+        Returns:
+            None
+        """
+        key = (table, values[:PARTITION_KEYS[table]])
+        partition = self._partitions.get(key)
+        if partition is None:
+            partition = self._partitions[key] = []
+        partition.append((statement, values))
+        self._buffered += 1
+
+        if len(partition) >= self.batch_size:
+            self._send(key, self._partitions.pop(key))
+        elif self._buffered > self.max_buffered:
+            self._send(*self._partitions.popitem(last=False))
+
+    def flush(self):
+        """Sends every buffered partition
+        Returns:
+            None
+        """
+        while self._partitions:
+            self._send(*self._partitions.popitem(last=False))
+
+    def _send(self, key, partition):
+        self._buffered -= len(partition)
+        table = key[0]
+        if len(partition) == 1:
+            self.writer.submit(table, *partition[0])
+            return
+
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for statement, values in partition:
+            batch.add(statement, values)
+        self.writer.submit(table, batch, rows=len(partition))
+
+
+def prepare_inserts(session):
+    """Prepares the insert statement of each table once
+    Args:
+        session (`cassandra.cluster.Session`): session connected to the keyspace
+    Returns:
+        dict: table name -> `cassandra.query.PreparedStatement`
+    """
+    return {table: session.prepare(query) for table, query in insert_queries.items()}
+
+
+def write_rows(chunks, statements, writer, batcher=None, quarantine=None):
+    """Parses each chunk of event rows for every table and sends the rows, through the
+    batcher if given. Rejected rows are written to the quarantine, or counted as errors
+    of the writer without one.
+    Args:
+        chunks (iterable): `pandas.DataFrame` chunks with `events.EVENT_COLUMNS`
+        statements (dict): table name -> prepared insert statement, see `prepare_inserts`
+        writer (`ConcurrentWriter`): writer sending the statements
+        batcher (`PartitionBatcher`): batcher grouping the rows by partition, if set
+        quarantine (`Quarantine`): file collecting the rejected rows, if set
+    Returns:
+        int: number of rows read
+    """
+    count = 0
+    for df in chunks:
+        count += len(df)
+        for table in table_columns:
+            rows, rejected, reasons = parse_chunk(df, table)
+            if quarantine:
+                quarantine.add(table, rejected, reasons)
+            else:
+                for reason in reasons:
+                    writer.reject(table, reason)
+            for values in rows:
+                if batcher:
+                    batcher.add(table, statements[table], values)
+                else:
+                    writer.submit(table, statements[table], values)
+    return count
+
+
+def build_report(writer, rows, seconds, quarantine=None):
+    """Collects the counters of a writer into a load report
+    Args:
+        writer (`ConcurrentWriter`): writer that sent the rows
+        rows (int): number of rows read
+        seconds (float): seconds spent
+        quarantine (`Quarantine`): file collecting the rejected rows, if used
+    Returns:
+        dict: rows read, seconds spent, rows written, requests sent, errors and quarantined
+            rows per table and error samples
+    """
+    return {
+        'rows': rows,
+        'seconds': seconds,
+        'written': dict(writer.written),
+        'requests': dict(writer.requests),
+        'errors': dict(writer.errors),
+        'quarantined': dict(quarantine.rows) if quarantine else {},
+        'error_samples': writer.error_samples,
+    }
+
+
+def load_events(session, chunks, concurrency=100, batch_size=None, max_buffered=10000, quarantine=None):
+    """Loads event rows into all tables in a single pass, each row is written to every
+    table with bounded concurrency as it is read, so rows are never held in memory
+    beyond the partitions being batched
+    Args:
+        session (`cassandra.cluster.Session`): session connected to the keyspace
+        chunks (iterable): `pandas.DataFrame` chunks with `events.EVENT_COLUMNS`, see `events.stream_events`
+        concurrency (int): maximum number of requests in flight
+        batch_size (int): maximum number of rows in a single partition batch, rows are
+            written one by one if None
+        max_buffered (int): maximum number of rows held in partitions waiting to be batched
+        quarantine (`Quarantine`): file collecting the rejected rows, rejected rows are
+            counted as errors if None
+    Returns:
+        dict: load report, see `build_report`
+    """
+    statements = prepare_inserts(session)
+    writer = ConcurrentWriter(session, concurrency)
+    batcher = PartitionBatcher(writer, batch_size, max_buffered) if batch_size else None
+
+    start = time.time()
+    count = write_rows(chunks, statements, writer, batcher, quarantine)
+    if batcher:
+        batcher.flush()
+    writer.wait()
+
+    return build_report(writer, count, time.time() - start, quarantine)
+
+
+def print_load_report(report):
+    """Prints the rows written, requests sent, errors and quarantined rows of each table, and the overall throughput
+    Args:
+        report (dict): load report, see `build_report`
+    Returns:
+        None
+    """
+    seconds = report['seconds']
+    total = sum(report['written'].values())
+    print('{} rows read in {:.2f}s, {} rows written in {} requests ({:.0f} rows/s)'.format(
+        report['rows'], seconds, total, sum(report['requests'].values()),
+        total / seconds if seconds else float('inf')))
+    for table in table_columns:
+        print('{:<14} {:>9} written {:>9} requests {:>6} errors {:>6} quarantined'.format(
+            table, report['written'].get(table, 0), report['requests'].get(table, 0),
+            report['errors'].get(table, 0), report['quarantined'].get(table, 0)))
+    for sample in report['error_samples']:
+        print('  ' + sample)
+
@@ -0,0 +1,218 @@
+import time
+import argparse
+import threading
+from collections import OrderedDict
+
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import DCAwareRoundRobinPolicy, TokenAwarePolicy
+from cql_queries import session_songs_select, user_sessions_select, song_users_select
+
+
+def connect(hosts, keyspace='sparkify'):
+    """Connects to the cluster with token aware routing, so each prepared query is sent to
+    a replica of the partition it reads
+    Args:
+        hosts (list): contact points of the cluster
+        keyspace (str): keyspace of the query tables
+    Returns:
+        tuple: `cassandra.cluster.Cluster` and its `cassandra.cluster.Session`
+    """
+    profile = ExecutionProfile(load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    cluster = Cluster(hosts, execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    return cluster, cluster.connect(keyspace)
+
+
+class ResultCache:
+    """Least recently used cache of query results, each expiring `ttl` seconds after it was stored.
+
+    Attributes:
+        hits (int): lookups answered from the cache
+        misses (int): lookups of keys not in the cache, or expired
+        expired (int): misses of keys that were in the cache but expired
+        evicted (int): results dropped to keep at most `max_entries`
+    """
+
+    def __init__(self, max_entries=1024, ttl=60, clock=time.monotonic):
+        """Initializes an empty cache
+        Args:
+            max_entries (int): maximum number of results kept
+            ttl (float): seconds a result is kept for
+            clock (callable): returns the current time in seconds
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Looks up a result
+        Args:
+            key (tuple): query name and parameters
+        Returns:
+            tuple: (True, result) if cached and not expired, (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key, result):
+        """Stores a result, evicting the least recently used ones past `max_entries`
+        Args:
+            key (tuple): query name and parameters
+            result (object): result to be cached
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self):
+        """Drops every cached result
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        """Returns the counters of the cache and its hit rate
+        Returns:
+            dict: entries, hits, misses, expired, evicted and hit_rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'hit_rate': self.hits / lookups if lookups else None,
+            }
+
+
+class SparkifyQueries:
+    """Answers the three access patterns of the query tables with prepared statements,
+    caching the results of repeated queries.
+
+    Listeners of a song are read in pages of `fetch_size` rows, so a popular song never
+    needs the whole partition in a single response. Results of more than `max_cached_rows`
+    rows are returned but not cached.
+    """
+
+    def __init__(self, session, cache=None, fetch_size=5000, max_cached_rows=10000):
+        """Prepares the statements of the queries
+        Args:
+            session (`cassandra.cluster.Session`): session connected to the keyspace, see `connect`
+            cache (`ResultCache`): cache of the results, results are not cached if None
+            fetch_size (int): number of rows read per page
+            max_cached_rows (int): maximum number of rows of a cached result
+        """
+        self.session = session
+        self.cache = cache
+        self.fetch_size = fetch_size
+        self.max_cached_rows = max_cached_rows
+        self.statements = {
+            'session_songs': session.prepare(session_songs_select),
+            'user_sessions': session.prepare(user_sessions_select),
+            'song_users': session.prepare(song_users_select),
+        }
+        for statement in self.statements.values():
+            statement.fetch_size = fetch_size
+
+    def session_item(self, session_id, session_item_id):
+        """Query 1: artist, song title and song's length heard at an item of a session
+        Args:
+            session_id (int): session id
+            session_item_id (int): item number in the session
+        Returns:
+            list: rows with artist, song_title and song_length
+        """
+        return self._query('session_songs', (session_id, session_item_id))
+
+    def user_session_playlist(self, user_id, session_id):
+        """Query 2: artist, song title and user name of a session of a user, ordered by item number
+        Args:
+            user_id (int): user id
+            session_id (int): session id
+        Returns:
+            list: rows with artist, song_title, first_name and last_name
+        """
+        return self._query('user_sessions', (user_id, session_id))
+
+    def song_listeners(self, song_title):
+        """Query 3: name of every user who listened to a song
+        Args:
+            song_title (str): song title
+        Returns:
+            list: rows with first_name and last_name
+        """
+        return self._query('song_users', (song_title,))
+
+    def iter_song_listeners(self, song_title):
+        """Streams the listeners of a song page by page, bypassing the cache
+        Args:
+            song_title (str): song title
+        Yields:
+            row with first_name and last_name
+        """
+        yield from self.session.execute(self.statements['song_users'], (song_title,))
+
+    def _query(self, name, parameters):
+        key = (name,) + parameters
+        if self.cache is not None:
+            found, rows = self.cache.get(key)
+            if found:
+                return rows
+
+        # iterating the result set fetches the following pages as they are needed
+        rows = list(self.session.execute(self.statements[name], parameters))
+
+        if self.cache is not None and len(rows) <= self.max_cached_rows:
+            self.cache.put(key, rows)
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Answers the three queries of the notebook from the query tables')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'], help='contact points of the cluster')
+    parser.add_argument('--cache-size', type=int, default=1024, help='maximum number of cached results')
+    parser.add_argument('--ttl', type=float, default=60, help='seconds a cached result is kept for')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times the queries are asked')
+    args = parser.parse_args()
+
+    cluster, session = connect(args.hosts)
+    queries = SparkifyQueries(session, cache=ResultCache(args.cache_size, args.ttl))
+
+    for i in range(args.repeat):
+        for row in queries.session_item(338, 4):
+            print(row.artist, row.song_title, row.song_length)
+        for row in queries.user_session_playlist(10, 182):
+            print(row.artist, row.song_title, row.first_name, row.last_name)
+        for row in queries.song_listeners('All Hands Against His Own'):
+            print(row.first_name, row.last_name)
+
+    print(queries.cache.metrics())
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
-import configparser
-import psycopg2
+import db
 from sql_queries import create_table_queries, drop_table_queries
 
 
@@ -38,13 +37,7 @@ def create_tables(cur, conn):
 def main():
     
     try:
-        config = configparser.ConfigParser()
-        config.read('dwh.cfg')
-    except Exception as e:
-        print(e)
-
-    try:
-        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        conn = db.connect(db.get_dsn('dwh.cfg'))
         cur = conn.cursor()
     except Exception as e:
         print(e)
@@ -1,69 +1,161 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import sys
+import time
+import argparse
+from datetime import datetime
+import db
+from sql_queries import (copy_table_queries, insert_queries, insert_dependencies, LOG_DATA, SONG_DATA, MANIFEST_PREFIX,
+                         staging_truncate_queries, watermark_select, new_events_drop, new_events_create,
+                         incremental_insert_queries, song_lookup_drop, watermark_delete, watermark_insert)
+from staging import get_slice_count, load_staging_parallel, print_copy_report
+from transform import run_queries, print_query_report
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(cur, conn, sources):
     """Load data from files stored in S3 to the staging tables using the queries declared on the sql_queries script
     Args:
         cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
         conn (`psycopg2.extensions.connection`): connection for database
+        sources (dict): staging table -> s3://bucket/prefix url of its files
     Returns:
         None
     """
-    for query in copy_table_queries:
+    for table, source in sources.items():
         try:
-            cur.execute(query)
+            cur.execute(copy_table_queries[table], (source.strip("'"),))
             conn.commit()
         except Exception as e:
             print(e)
 
 
 
-def insert_tables(cur, conn):
-    """Select and Transform data from staging tables into the dimensional tables using the queries declared on the sql_queries script
+def insert_tables(pool, workers=4):
+    """Select and Transform data from staging tables into the dimensional tables using the queries declared on the sql_queries script.
+    Queries not depending on each other run at the same time, each on a connection of the pool, and the ones
+    depending on a failed query are skipped.
+    Args:
+        pool (`db.ConnectionPool`): pool of at least `workers` connections
+        workers (int): number of queries run at the same time
+    Returns:
+        bool: True if every table was loaded
+    """
+    start = time.time()
+    results = run_queries(pool, insert_queries, insert_dependencies, workers=workers)
+    print_query_report(results, time.time() - start)
+    return all(result['status'] == 'ok' for result in results)
+
+
+def truncate_staging_tables(cur, conn):
+    """Empties the staging tables, so they hold only the files of the current load
     Args:
         cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
         conn (`psycopg2.extensions.connection`): connection for database
     Returns:
         None
     """
-    for query in insert_table_queries:
-        try:
-            cur.execute(query)
-            conn.commit()
-        except Exception as e:
-            print(e)
+    for query in staging_truncate_queries:
+        cur.execute(query)
+    conn.commit()
 
 
-def main():
-    
+def insert_tables_incremental(cur, conn, queries=incremental_insert_queries):
+    """Merges the events staged after the high watermark of the previous load into the dimensional tables.
+    Songplays and users of the new events are deleted and inserted again, songs, artists and time get
+    only the keys they do not hold yet. The watermark moves to the latest new event in the same transaction,
+    so a failed load is rolled back as a whole and retried by the next run.
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        queries (list): (table, statement or statements) run in order, see `incremental_insert_queries`
+    Returns:
+        bool: True if the new events were merged, False if the load was rolled back
+    """
     try:
-        config = configparser.ConfigParser()
-        config.read('dwh.cfg')
+        cur.execute(watermark_select)
+        row = cur.fetchone()
+        watermark = row[0] if row and row[0] else datetime(1970, 1, 1)
+        print('Merging the events after {}'.format(watermark))
+
+        cur.execute(new_events_drop)
+        cur.execute(new_events_create, (watermark,))
+        print('{:<10} {:>8} new events'.format('staging', cur.rowcount))
+        for table, query in queries:
+            statements = [query] if isinstance(query, str) else query
+            for statement in statements:
+                cur.execute(statement)
+            print('{:<10} {:>8} rows {}'.format(table, cur.rowcount, statements[-1].split()[0].lower()))
+
+        cur.execute(watermark_delete)
+        cur.execute(watermark_insert, (datetime.utcnow(),))
+        cur.execute(song_lookup_drop)
+        cur.execute(new_events_drop)
+        conn.commit()
+        return True
     except Exception as e:
+        conn.rollback()
         print(e)
-    
-    
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stages the S3 data in Redshift and loads the tables')
+    parser.add_argument('--staging', choices=('serial', 'parallel'), default='serial',
+                        help='serial: one COPY per staging table one after the other, '
+                             'parallel: concurrent COPYs of manifests each listing a group of files')
+    parser.add_argument('--copy-workers', type=int, default=4, help='number of COPYs run at the same time')
+    parser.add_argument('--copy-groups', type=int, default=1, help='number of file groups of each staging table')
+    parser.add_argument('--log-data', default=LOG_DATA, help='s3 prefix or local directory of the log files')
+    parser.add_argument('--song-data', default=SONG_DATA, help='s3 prefix or local directory of the song files')
+    parser.add_argument('--staging-only', action='store_true', help='stops once the staging tables are loaded')
+    parser.add_argument('--insert-workers', type=int, default=4,
+                        help='number of inserts into the dimensional tables run at the same time')
+    parser.add_argument('--incremental', action='store_true',
+                        help='empties the staging tables first, and merges only the events after the high '
+                             'watermark of the previous load into the tables')
+    args = parser.parse_args()
+
+    sources = {'staging_events': args.log_data, 'staging_songs': args.song_data}
+    if args.staging == 'serial' and not all(source.strip("'").startswith('s3://') for source in sources.values()):
+        parser.error('local directories are loaded with --staging parallel')
+
+    dsn = db.get_dsn('dwh.cfg')
     try:
-        conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+        conn = db.connect(dsn)
         cur = conn.cursor()
     except Exception as e:
         print(e)
 
-       
-    load_staging_tables(cur, conn)
+    if args.incremental:
+        truncate_staging_tables(cur, conn)
+
+    if args.staging == 'parallel':
+        pool = db.ConnectionPool(dsn, maxconn=args.copy_workers)
+        start = time.time()
+        results = load_staging_parallel(pool, sources, workers=args.copy_workers, groups=args.copy_groups,
+                                        slices=get_slice_count(cur, conn), manifest_prefix=MANIFEST_PREFIX)
+        print_copy_report(results, time.time() - start)
+        pool.closeall()
+    else:
+        load_staging_tables(cur, conn, sources)
     print("Staging is completed")
-    
-    insert_tables(cur, conn)
-    print("Loading is completed")
+
+    loaded = True
+    if not args.staging_only:
+        if args.incremental:
+            loaded = insert_tables_incremental(cur, conn)
+        else:
+            pool = db.ConnectionPool(dsn, maxconn=args.insert_workers)
+            loaded = insert_tables(pool, workers=args.insert_workers)
+            pool.closeall()
+        print("Loading is completed" if loaded else "Loading failed")
     
     
     try:
         conn.close()
     except Exception as e:
         print(e)
-        
+
+    if not loaded:
+        sys.exit(1)
     print("ETL is completed. All tables in sql_queries.py have been inserted with data. (etl.py is completed!)")
 
 
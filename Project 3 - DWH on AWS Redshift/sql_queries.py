@@ -9,6 +9,7 @@ ARN = config.get('IAM_ROLE','ARN')
 LOG_DATA = config.get('S3','LOG_DATA')
 LOG_JSONPATH = config.get('S3','LOG_JSONPATH')
 SONG_DATA = config.get('S3','SONG_DATA')
+MANIFEST_PREFIX = config.get('S3','MANIFEST_PREFIX', fallback=None)
 
 
 # DROP TABLES
@@ -19,6 +20,7 @@ user_table_drop = "DROP TABLE IF EXISTS users CASCADE"
 song_table_drop = "DROP TABLE IF EXISTS songs CASCADE"
 artist_table_drop = "DROP TABLE IF EXISTS artists CASCADE"
 time_table_drop = "DROP TABLE IF EXISTS time CASCADE"
+load_watermark_table_drop = "DROP TABLE IF EXISTS load_watermark CASCADE"
 
 # CREATE TABLES
 
@@ -115,25 +117,91 @@ CREATE TABLE IF NOT EXISTS time (
     DISTSTYLE ALL;
 """)
 
-# STAGING TABLES
+# high watermark of staging_events.ts merged into the final tables by the incremental load
+load_watermark_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_watermark (
+    table_name VARCHAR PRIMARY KEY,
+    high_watermark TIMESTAMP,
+    loaded_at TIMESTAMP);
+""")
+
+# STAGING TABLES, THE S3 PREFIX IS PASSED AS QUERY PARAMETER
 
 staging_events_copy = ("""
 COPY staging_events
-FROM {}
+FROM %s
 IAM_ROLE {}
 REGION 'us-west-2' FORMAT AS JSON {}
 timeformat as 'epochmillisecs';
-""").format(LOG_DATA,ARN,LOG_JSONPATH)
+""").format(ARN,LOG_JSONPATH)
 
 staging_songs_copy = ("""
 COPY staging_songs
-FROM {}
+FROM %s
 IAM_ROLE {}
 REGION 'us-west-2' FORMAT AS JSON 'auto';
-""").format(SONG_DATA,ARN)
+""").format(ARN)
+
+# STAGING TABLES FROM MANIFESTS, THE MANIFEST URL IS PASSED AS QUERY PARAMETER
+
+staging_events_copy_manifest = ("""
+COPY staging_events
+FROM %s
+IAM_ROLE {}
+REGION 'us-west-2' FORMAT AS JSON {}
+timeformat as 'epochmillisecs'
+MANIFEST;
+""").format(ARN,LOG_JSONPATH)
+
+staging_songs_copy_manifest = ("""
+COPY staging_songs
+FROM %s
+IAM_ROLE {}
+REGION 'us-west-2' FORMAT AS JSON 'auto'
+MANIFEST;
+""").format(ARN)
+
+# files and rows loaded by the last COPY of the session
+copy_stats_select = ("""
+SELECT count(*), sum(lines_scanned)
+FROM stl_load_commits
+WHERE query = pg_last_copy_id();
+""")
+
+slice_count_select = ("""
+SELECT count(*)
+FROM stv_slices;
+""")
+
+# local stand-in of the COPY from S3, rows read from local files are sent as csv
+staging_copy_from_stdin = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
 
 # FINAL TABLES
 
+# one song per (title, artist_name, duration) of the events, so duplicate staging_songs rows do not
+# multiply the songplays. Lives in the session of the songplays insert, see insert_queries.
+song_lookup_drop = "DROP TABLE IF EXISTS song_lookup"
+
+song_lookup_create = ("""
+CREATE TEMP TABLE song_lookup
+    DISTKEY(title)
+    SORTKEY(title, artist_name, duration)
+AS
+    SELECT 
+        title,
+        artist_name,
+        duration,
+        song_id,
+        artist_id
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY title, artist_name, duration ORDER BY song_id) AS first
+        FROM staging_songs) s
+    WHERE first = 1;
+""")
+
+# statistics of the lookup, so the planner hashes the lookup rather than the events
+song_lookup_analyze = "ANALYZE song_lookup"
+
 songplay_table_insert = ("""
 INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
     SELECT  
@@ -145,22 +213,27 @@ INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_i
         e.sessionId as session_id, 
         e.location,
         e.useragent as user_agent
-    FROM staging_events e, staging_songs s
-    WHERE e.song = s.title
-    AND e.artist = s.artist_name
-    AND page = 'NextSong';
+    FROM staging_events e
+    JOIN song_lookup s
+    ON (e.song = s.title AND e.artist = s.artist_name AND e.length = s.duration)
+    WHERE e.page = 'NextSong';
 """)
 
+# one row per user, with the level of their latest event
 user_table_insert = ("""
 INSERT INTO users (user_id, first_name, last_name, gender, level)
-     SELECT DISTINCT 
+    SELECT 
         userId as user_id,
         firstName as first_name,
         lastName as last_name, 
         gender, 
         level
-    FROM staging_events
-    WHERE page = 'NextSong';
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS latest
+        FROM staging_events
+        WHERE page = 'NextSong'
+        AND userId IS NOT NULL) e
+    WHERE latest = 1;
 """)
 
 song_table_insert = ("""
@@ -198,9 +271,180 @@ INSERT INTO time (start_time, hour, day, week, month, year, weekday)
     FROM songplays;
 """)
 
+# INCREMENTAL LOAD: ONLY THE EVENTS NEWER THAN THE WATERMARK ARE MERGED INTO THE FINAL TABLES
+
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+watermark_select = ("""
+SELECT high_watermark
+FROM load_watermark
+WHERE table_name = 'staging_events';
+""")
+
+new_events_drop = "DROP TABLE IF EXISTS new_events"
+
+new_events_create = ("""
+CREATE TEMP TABLE new_events AS
+    SELECT *
+    FROM staging_events
+    WHERE page = 'NextSong'
+    AND ts > %s;
+""")
+
+# song_lookup of the titles of the new events, from the songs and artists tables, which hold the songs
+# of the previous loads too. One song per (title, artist name, duration), as duplicate songs and artists
+# rows of earlier loads would multiply the songplays.
+song_lookup_new_create = ("""
+CREATE TEMP TABLE song_lookup
+    DISTKEY(title)
+    SORTKEY(title, artist_name, duration)
+AS
+    SELECT 
+        title,
+        artist_name,
+        duration,
+        song_id,
+        artist_id
+    FROM (
+        SELECT 
+            s.title, 
+            a.name as artist_name, 
+            s.duration, 
+            s.song_id, 
+            s.artist_id,
+            ROW_NUMBER() OVER (PARTITION BY s.title, a.name, s.duration ORDER BY s.song_id) AS first
+        FROM songs s
+        JOIN artists a ON (s.artist_id = a.artist_id)
+        WHERE s.title IN (SELECT DISTINCT song FROM new_events)) l
+    WHERE first = 1;
+""")
+
+# delete-insert merge of the songplays of the new events, so reloading the same events replaces them
+songplay_table_delete_new = ("""
+DELETE FROM songplays
+USING new_events e
+WHERE songplays.start_time = e.ts
+AND songplays.user_id = e.userId
+AND songplays.session_id = e.sessionId;
+""")
+
+songplay_table_insert_new = ("""
+INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT 
+        e.ts as start_time, 
+        e.userId as user_id, 
+        e.level, 
+        s.song_id, 
+        s.artist_id, 
+        e.sessionId as session_id, 
+        e.location,
+        e.useragent as user_agent
+    FROM new_events e
+    JOIN song_lookup s
+    ON (e.song = s.title AND e.artist = s.artist_name AND e.length = s.duration);
+""")
+
+# delete-insert merge of the users of the new events, with the level of their latest event
+user_table_delete_new = ("""
+DELETE FROM users
+USING (SELECT DISTINCT userId FROM new_events) e
+WHERE users.user_id = e.userId;
+""")
+
+user_table_insert_new = ("""
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+    SELECT 
+        userId as user_id,
+        firstName as first_name,
+        lastName as last_name, 
+        gender, 
+        level
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS latest
+        FROM new_events
+        WHERE userId IS NOT NULL) e
+    WHERE latest = 1;
+""")
+
+song_table_insert_new = ("""
+INSERT INTO songs (song_id, title, artist_id, year, duration)
+    SELECT 
+        song_id,
+        title,
+        artist_id,
+        year, 
+        duration
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY title) AS first
+        FROM staging_songs) s
+    WHERE first = 1
+    AND NOT EXISTS (SELECT 1 FROM songs WHERE songs.song_id = s.song_id);
+""")
+
+artist_table_insert_new = ("""
+INSERT INTO artists (artist_id, name, location, latitude, longitude)
+    SELECT 
+        artist_id, 
+        artist_name as name, 
+        artist_location as location,
+        artist_latitude as latitude, 
+        artist_longitude as longitude
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY artist_id ORDER BY artist_name) AS first
+        FROM staging_songs) s
+    WHERE first = 1
+    AND NOT EXISTS (SELECT 1 FROM artists WHERE artists.artist_id = s.artist_id);
+""")
+
+time_table_insert_new = ("""
+INSERT INTO time (start_time, hour, day, week, month, year, weekday)
+    SELECT 
+        start_time, 
+        extract(hour from start_time) as hour, 
+        extract(day from start_time) as day, 
+        extract(week from start_time) as week, 
+        extract(month from start_time) as month, 
+        extract(year from start_time) as year, 
+        extract(dayofweek from start_time) as weekday
+    FROM (
+        SELECT DISTINCT start_time
+        FROM songplays
+        WHERE start_time >= (SELECT min(ts) FROM new_events)) sp
+    WHERE NOT EXISTS (SELECT 1 FROM time WHERE time.start_time = sp.start_time);
+""")
+
+watermark_delete = ("""
+DELETE FROM load_watermark
+WHERE table_name = 'staging_events'
+AND EXISTS (SELECT 1 FROM new_events);
+""")
+
+watermark_insert = ("""
+INSERT INTO load_watermark (table_name, high_watermark, loaded_at)
+    SELECT 'staging_events', max(ts), %s
+    FROM new_events
+    HAVING count(*) > 0;
+""")
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, load_watermark_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, load_watermark_table_drop]
+copy_table_queries = {'staging_events': staging_events_copy, 'staging_songs': staging_songs_copy}
+copy_manifest_queries = {'staging_events': staging_events_copy_manifest, 'staging_songs': staging_songs_copy_manifest}
+# table -> statement, or statements run in order on the same connection, loading it
+insert_queries = {'songplays': [song_lookup_drop, song_lookup_create, song_lookup_analyze, songplay_table_insert], 'users': user_table_insert,
+                  'songs': song_table_insert, 'artists': artist_table_insert, 'time': time_table_insert}
+# table -> tables its insert reads from, the other inserts only read the staging tables
+insert_dependencies = {'time': ['songplays']}
+staging_truncate_queries = [staging_events_truncate, staging_songs_truncate]
+# (table, statement or statements) run in order in a single transaction after new_events_create,
+# song_lookup is built once songs and artists hold the songs of the new events
+incremental_insert_queries = [
+    ('songs', song_table_insert_new), ('artists', artist_table_insert_new),
+    ('users', user_table_delete_new), ('users', user_table_insert_new),
+    ('songplays', songplay_table_delete_new),
+    ('songplays', [song_lookup_drop, song_lookup_new_create, song_lookup_analyze, songplay_table_insert_new]),
+    ('time', time_table_insert_new),
+]
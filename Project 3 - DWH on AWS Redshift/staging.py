@@ -0,0 +1,208 @@
+import io
+import os
+import csv
+import glob
+import json
+import math
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from sql_queries import copy_manifest_queries, copy_stats_select, slice_count_select, staging_copy_from_stdin
+
+
+# staging table -> json keys of a record, in the order of the table's columns
+STAGING_COLUMNS = {
+    'staging_events': ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+                       'level', 'location', 'method', 'page', 'registration', 'sessionId', 'song',
+                       'status', 'ts', 'userAgent', 'userId'],
+    'staging_songs': ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude', 'artist_location',
+                      'artist_name', 'song_id', 'title', 'duration', 'year'],
+}
+
+
+def get_slice_count(cur, conn, default=1):
+    """Returns the number of slices of the cluster
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        default (int): slice count used when the database is not a Redshift cluster
+    Returns:
+        int: number of slices
+    """
+    try:
+        cur.execute(slice_count_select)
+        return cur.fetchone()[0]
+    except psycopg2.Error:
+        conn.rollback()
+        return default
+
+
+def split_s3_url(url):
+    """Splits an s3://bucket/key url into bucket and key"""
+    bucket, _, key = url.strip("'")[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def list_files(source):
+    """Lists the json files under an S3 prefix or a local directory
+    Args:
+        source (str): s3://bucket/prefix url, or path of a local directory
+    Returns:
+        list: sorted s3 urls or local filepaths of the files
+    """
+    source = source.strip("'")
+    if not source.startswith('s3://'):
+        return sorted(glob.glob(os.path.join(source, '**', '*.json'), recursive=True))
+
+    import boto3
+    bucket, prefix = split_s3_url(source)
+    files = []
+    for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        files += ['s3://{}/{}'.format(bucket, obj['Key']) for obj in page.get('Contents', [])
+                  if obj['Key'].endswith('.json')]
+    return sorted(files)
+
+
+def group_files(files, groups, slices):
+    """Splits files into at most `groups` groups, each holding a multiple of `slices` files
+    but the last, so every slice loads the same number of files in each COPY
+    Args:
+        files (list): files to be loaded
+        groups (int): number of groups wanted
+        slices (int): number of slices of the cluster
+    Returns:
+        list: lists of files
+    """
+    size = math.ceil(len(files) / max(groups, 1) / slices) * slices or slices
+    return [files[i:i + size] for i in range(0, len(files), size)]
+
+
+def write_manifest(files, url):
+    """Writes a COPY manifest listing files to S3
+    Args:
+        files (list): s3 urls of the files
+        url (str): s3 url of the manifest
+    Returns:
+        None
+    """
+    import boto3
+    bucket, key = split_s3_url(url)
+    manifest = {'entries': [{'url': f, 'mandatory': True} for f in files]}
+    boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf8'))
+
+
+def read_records(filepath):
+    """Reads the json records of a local song or log file, one record per line"""
+    with open(filepath, encoding='utf8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def to_csv_value(key, value):
+    """Turns a json value into a csv value of the COPY, timestamps are in epoch milliseconds
+    as with the `timeformat as 'epochmillisecs'` of the S3 COPY"""
+    if value is None or value == '':
+        return '\\N'
+    if key == 'ts':
+        return (datetime(1970, 1, 1) + timedelta(milliseconds=value)).isoformat()
+    return value
+
+
+def copy_local_files(cur, table, files):
+    """Local stand-in of a COPY from a manifest: copies local json files into a staging table
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        table (str): staging table name
+        files (list): filepaths of the json files
+    Returns:
+        int: number of rows loaded
+    """
+    keys = STAGING_COLUMNS[table]
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for f in files:
+        for record in read_records(f):
+            writer.writerow([to_csv_value(key, record.get(key)) for key in keys])
+    buf.seek(0)
+    cur.copy_expert(staging_copy_from_stdin.format(table=table, columns=', '.join(keys)), buf)
+    return cur.rowcount
+
+
+def copy_group(pool, task):
+    """Runs the COPY of a file group on a connection of its own, committed on success
+    Args:
+        pool (`db.ConnectionPool`): pool of connections
+        task (dict): table, group number, files and s3 url of the manifest, None for local files
+    Returns:
+        dict: the task with the rows loaded, seconds spent and error, if any
+    """
+    start = time.time()
+    result = dict(task, rows=None, error=None)
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            if task['manifest']:
+                cur.execute(copy_manifest_queries[task['table']], (task['manifest'],))
+                cur.execute(copy_stats_select)
+                files, rows = cur.fetchone()
+                result['rows'] = rows
+            else:
+                result['rows'] = copy_local_files(cur, task['table'], task['files'])
+    except Exception as e:
+        result['error'] = str(e).strip()
+    result['seconds'] = time.time() - start
+    return result
+
+
+def load_staging_parallel(pool, sources, workers=4, groups=1, slices=1, manifest_prefix=None):
+    """Loads the staging tables with concurrent COPYs, each table's files split into groups
+    listed in manifests. COPYs of different tables run side by side; COPYs of groups of the
+    same table do too, though Redshift queues concurrent writes to a single table.
+    Args:
+        pool (`db.ConnectionPool`): pool of at least `workers` connections
+        sources (dict): staging table -> s3://bucket/prefix url or local directory of its files
+        workers (int): number of COPYs run at the same time
+        groups (int): number of file groups of each table
+        slices (int): number of slices of the cluster, the size of a group is a multiple of it
+        manifest_prefix (str): s3://bucket/prefix url the manifests are written to, required for s3 sources
+    Returns:
+        list: result of each COPY, see `copy_group`
+    Raises:
+        ValueError: on s3 sources without a manifest_prefix, before any file is listed
+    """
+    s3_sources = [source.strip("'") for source in sources.values() if source.strip("'").startswith('s3://')]
+    if s3_sources and not manifest_prefix:
+        raise ValueError('MANIFEST_PREFIX in the [S3] section of dwh.cfg is required to copy {}'.format(
+            ', '.join(s3_sources)))
+
+    tasks = []
+    for table, source in sources.items():
+        files = list_files(source)
+        print('{} files found in {}'.format(len(files), source))
+        for i, group in enumerate(group_files(files, groups, slices)):
+            manifest = None
+            if group[0].startswith('s3://'):
+                manifest = '{}/{}-{}.manifest'.format(manifest_prefix.strip("'").rstrip('/'), table, i)
+                write_manifest(group, manifest)
+            tasks.append({'table': table, 'group': i, 'files': group, 'manifest': manifest})
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda task: copy_group(pool, task), tasks))
+
+
+def print_copy_report(results, seconds):
+    """Prints files, rows and time of each COPY, and the wall clock time against their sum
+    Args:
+        results (list): result of each COPY, see `copy_group`
+        seconds (float): wall clock time of all COPYs
+    Returns:
+        None
+    """
+    for result in results:
+        status = result['error'] or '{} rows'.format(result['rows'])
+        print('{:<15} group {:>3} {:>6} files in {:>8.2f}s, {}'.format(
+            result['table'], result['group'], len(result['files']), result['seconds'], status))
+    total = sum(result['seconds'] for result in results)
+    print('{} COPYs in {:.2f}s, {:.2f}s if run one after the other ({:.1f}x)'.format(
+        len(results), seconds, total, total / seconds if seconds else float('inf')))
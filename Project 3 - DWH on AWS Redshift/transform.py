@@ -0,0 +1,117 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def check_dependencies(queries, dependencies):
+    """Checks that every dependency is a query of its own and that no query depends on itself, even through others
+    Args:
+        queries (dict): table -> query loading it
+        dependencies (dict): table -> tables loaded before it
+    Returns:
+        None
+    Raises:
+        ValueError: on an unknown table or a dependency cycle
+    """
+    for table, upstream in dependencies.items():
+        for name in [table] + list(upstream):
+            if name not in queries:
+                raise ValueError('no query loads {}'.format(name))
+
+    visiting, visited = set(), set()
+
+    def visit(table):
+        if table in visiting:
+            raise ValueError('dependency cycle through {}'.format(table))
+        if table not in visited:
+            visiting.add(table)
+            for upstream in dependencies.get(table, []):
+                visit(upstream)
+            visiting.discard(table)
+            visited.add(table)
+
+    for table in queries:
+        visit(table)
+
+
+def run_query(pool, table, query):
+    """Runs the query loading a table on a connection of its own, committed on success
+    Args:
+        pool (`db.ConnectionPool`): pool of connections
+        table (str): table loaded by the query
+        query (str or list): INSERT ... SELECT statement, or statements run one after the other in the
+            same transaction, e.g. to create the temp tables read by the INSERT ... SELECT coming last
+    Returns:
+        dict: table, status ('ok' or 'failed'), rows inserted, seconds spent and error, if any
+    """
+    statements = [query] if isinstance(query, str) else list(query)
+    start = time.time()
+    result = {'table': table, 'status': 'ok', 'rows': None, 'error': None}
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            for statement in statements[:-1]:
+                cur.execute(statement)
+            cur.execute(statements[-1])
+            result['rows'] = cur.rowcount
+    except Exception as e:
+        result.update(status='failed', error=str(e).strip())
+    result['seconds'] = time.time() - start
+    return result
+
+
+def run_queries(pool, queries, dependencies, workers=4):
+    """Runs the queries loading the tables, each one as soon as the tables it depends on are loaded,
+    at most `workers` at the same time. Queries depending on a failed one, even through others,
+    are skipped.
+    Args:
+        pool (`db.ConnectionPool`): pool of at least `workers` connections
+        queries (dict): table -> query loading it, see `run_query`
+        dependencies (dict): table -> tables loaded before it
+        workers (int): number of queries run at the same time
+    Returns:
+        list: result of each query in the order they ended, see `run_query`, skipped ones with status 'skipped'
+    """
+    check_dependencies(queries, dependencies)
+
+    status = {}
+    results = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(status) < len(queries):
+            for table, query in queries.items():
+                if table in status or table in running.values():
+                    continue
+                upstream = dependencies.get(table, [])
+                broken = [name for name in upstream if status.get(name) in ('failed', 'skipped')]
+                if broken:
+                    status[table] = 'skipped'
+                    results.append({'table': table, 'status': 'skipped', 'rows': None, 'seconds': 0.0,
+                                    'error': 'skipped, {} not loaded'.format(', '.join(broken))})
+                elif all(status.get(name) == 'ok' for name in upstream):
+                    running[executor.submit(run_query, pool, table, query)] = table
+
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                result = future.result()
+                status[result['table']] = result['status']
+                results.append(result)
+    return results
+
+
+def print_query_report(results, seconds):
+    """Prints status, rows and time of each query, and the wall clock time against their sum
+    Args:
+        results (list): result of each query, see `run_queries`
+        seconds (float): wall clock time of all queries
+    Returns:
+        None
+    """
+    for result in results:
+        status = result['error'] or '{} rows'.format(result['rows'])
+        print('{:<10} {:<8} in {:>8.2f}s, {}'.format(result['table'], result['status'], result['seconds'], status))
+    total = sum(result['seconds'] for result in results)
+    print('{} queries in {:.2f}s, {:.2f}s if run one after the other ({:.1f}x)'.format(
+        len(results), seconds, total, total / seconds if seconds else float('inf')))
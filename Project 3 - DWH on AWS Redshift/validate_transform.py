@@ -0,0 +1,196 @@
+import re
+import time
+import argparse
+
+import db
+from etl import insert_tables_incremental
+from sql_queries import (songplay_table_create, user_table_create, time_table_create, insert_queries,
+                         staging_events_table_create, staging_songs_table_create, song_table_create,
+                         artist_table_create, load_watermark_table_create, incremental_insert_queries)
+
+
+# the songplays and users inserts replaced by the song lookup and the latest level of each user
+BASELINE_QUERIES = {
+    'songplays': ("""
+INSERT INTO songplays (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+    SELECT
+        e.ts as start_time,
+        e.userId as user_id,
+        e.level,
+        s.song_id,
+        s.artist_id,
+        e.sessionId as session_id,
+        e.location,
+        e.useragent as user_agent
+    FROM staging_events e, staging_songs s
+    WHERE e.song = s.title
+    AND e.artist = s.artist_name
+    AND page = 'NextSong';
+"""),
+    'users': ("""
+INSERT INTO users (user_id, first_name, last_name, gender, level)
+     SELECT DISTINCT
+        userId as user_id,
+        firstName as first_name,
+        lastName as last_name,
+        gender,
+        level
+    FROM staging_events
+    WHERE page = 'NextSong';
+"""),
+    'time': insert_queries['time'],
+}
+
+REWORKED_QUERIES = {table: insert_queries[table] for table in BASELINE_QUERIES}
+
+# rows and distinct keys of each table, more rows than keys are duplicates
+TABLE_KEYS = {
+    'songplays': 'start_time, user_id, session_id',
+    'users': 'user_id',
+    'time': 'start_time',
+}
+
+
+def to_postgres(query):
+    """Strips the Redshift only parts of a query so it runs on PostgreSQL. Keys are dropped too,
+    as Redshift does not enforce them and duplicates have to be counted rather than rejected.
+    Args:
+        query (str): Redshift query
+    Returns:
+        str: PostgreSQL query
+    """
+    query = query.replace('INT IDENTITY(0,1)', 'SERIAL')
+    query = re.sub(r'\s*DISTSTYLE ALL', '', query)
+    query = re.sub(r'\b(DISTKEY|SORTKEY)(\([^)]*\))?', '', query)
+    query = re.sub(r'\s*(PRIMARY KEY|REFERENCES \w+\(\w+\))', '', query)
+    return query.replace('dayofweek', 'dow')
+
+
+def create_staging(cur, conn, scale, song_copies):
+    """Copies the staging tables of the public schema into the validate_staging schema,
+    each event `scale` times and each song `song_copies` times
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        scale (int): copies of each event
+        song_copies (int): copies of each song, more than one duplicates the songs
+    Returns:
+        None
+    """
+    cur.execute('DROP SCHEMA IF EXISTS validate_staging CASCADE')
+    cur.execute('CREATE SCHEMA validate_staging')
+    cur.execute('SET search_path TO validate_staging')
+    cur.execute(to_postgres(staging_events_table_create))
+    cur.execute(to_postgres(staging_songs_table_create))
+    cur.execute('INSERT INTO staging_events SELECT e.* FROM public.staging_events e, generate_series(1, %s)', (scale,))
+    cur.execute('INSERT INTO staging_songs SELECT s.* FROM public.staging_songs s, generate_series(1, %s)',
+                (song_copies,))
+    cur.execute('ANALYZE staging_events')
+    cur.execute('ANALYZE staging_songs')
+    conn.commit()
+
+
+def run_variant(cur, conn, name, queries):
+    """Loads songplays, users and time in a schema of their own with the queries of a variant
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        name (str): name of the variant, and of its schema
+        queries (dict): table -> statement, or statements, loading it
+    Returns:
+        dict: table -> (rows, distinct keys, seconds)
+    """
+    cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}'.format(name))
+    cur.execute('SET search_path TO {}, validate_staging'.format(name))
+    for query in (user_table_create, time_table_create, songplay_table_create):
+        cur.execute(to_postgres(query))
+    conn.commit()
+
+    report = {}
+    for table, query in queries.items():
+        start = time.time()
+        for statement in [query] if isinstance(query, str) else query:
+            cur.execute(to_postgres(statement))
+        conn.commit()
+        seconds = time.time() - start
+        cur.execute('SELECT count(*), count(DISTINCT ({})) FROM {}'.format(TABLE_KEYS[table], table))
+        report[table] = cur.fetchone() + (seconds,)
+    return report
+
+
+def run_incremental(cur, conn, name='incremental'):
+    """Loads songplays, users and time in a schema of their own with `etl.insert_tables_incremental`
+    in two runs, the first one staging the events before the median ts and the second one all events
+    Args:
+        cur (`psycopg2.extensions.cursor`): Cusrsor for db connection
+        conn (`psycopg2.extensions.connection`): connection for database
+        name (str): name of the variant, and of its schema
+    Returns:
+        dict: table -> (rows, distinct keys, seconds), None if a run was rolled back
+    """
+    cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}'.format(name))
+    cur.execute('SET search_path TO {}, validate_staging'.format(name))
+    for query in (user_table_create, song_table_create, artist_table_create, time_table_create,
+                  songplay_table_create, load_watermark_table_create):
+        cur.execute(to_postgres(query))
+
+    # staging_events of the schema hides the one of validate_staging
+    split = 'SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY ts) FROM validate_staging.staging_events'
+    cur.execute('CREATE TABLE staging_events AS SELECT * FROM validate_staging.staging_events '
+                'WHERE ts < ({})'.format(split))
+    conn.commit()
+
+    queries = [(table, to_postgres(query) if isinstance(query, str) else [to_postgres(q) for q in query])
+               for table, query in incremental_insert_queries]
+    start = time.time()
+    loaded = insert_tables_incremental(cur, conn, queries)
+    cur.execute('INSERT INTO staging_events SELECT * FROM validate_staging.staging_events '
+                'WHERE ts >= ({})'.format(split))
+    conn.commit()
+    loaded = insert_tables_incremental(cur, conn, queries) and loaded
+    seconds = time.time() - start
+    if not loaded:
+        return None
+
+    report = {}
+    for table in TABLE_KEYS:
+        cur.execute('SELECT count(*), count(DISTINCT ({})) FROM {}'.format(TABLE_KEYS[table], table))
+        report[table] = cur.fetchone() + (seconds,)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the rows and runtime of the songplays, users and time inserts against the ones '
+                    'they replaced, on a local PostgreSQL holding the staging tables, set in the [CLUSTER] section of dwh.cfg')
+    parser.add_argument('--scale', type=int, default=1, help='copies of each staged event')
+    parser.add_argument('--song-copies', type=int, default=1, help='copies of each staged song')
+    parser.add_argument('--incremental', action='store_true',
+                        help='also loads the tables with the incremental merge of etl.py, in two runs')
+    args = parser.parse_args()
+
+    conn = db.connect(db.get_dsn('dwh.cfg'))
+    cur = conn.cursor()
+    create_staging(cur, conn, args.scale, args.song_copies)
+
+    reports = {name: run_variant(cur, conn, name, queries)
+               for name, queries in (('baseline', BASELINE_QUERIES), ('reworked', REWORKED_QUERIES))}
+    if args.incremental:
+        reports['incremental'] = run_incremental(cur, conn)
+        if reports['incremental'] is None:
+            print('Incremental merge failed')
+            del reports['incremental']
+
+    print('{:<10} {:<12} {:>10} {:>10} {:>10}'.format('table', 'variant', 'rows', 'keys', 'seconds'))
+    for table in BASELINE_QUERIES:
+        for name, report in reports.items():
+            rows, keys, seconds = report[table]
+            print('{:<10} {:<12} {:>10} {:>10} {:>10.2f}'.format(table, name, rows, keys, seconds))
+
+    cur.execute('DROP SCHEMA IF EXISTS baseline, reworked, incremental, validate_staging CASCADE')
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import zipfile
+import argparse
+import tempfile
+from datetime import datetime
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import udf, col
+from pyspark.sql.types import TimestampType
+
+from etl import with_start_time, extract_time_table
+
+
+def with_start_time_udf(df):
+    """start_time of the ts column with the Python udf replaced by `etl.with_start_time`,
+    truncated to the second and in the timezone of the Python worker"""
+    get_datetime = udf(lambda ms: datetime.fromtimestamp(ms // 1000), TimestampType())
+    return df.withColumn("start_time", get_datetime(col("ts")))
+
+
+def run_benchmark(spark, df, name, add_start_time, repeat):
+    """Builds the time table of the events `repeat` times, writing it to the noop sink so every row is computed
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        df(:obj:`pyspark.sql.DataFrame`): cached NextSong events
+        name (str): name of the variant
+        add_start_time (callable): adds the start_time column to the events
+        repeat (int): number of runs, the best one is kept
+    Returns:
+        dict: benchmark result
+    """
+    rows = df.count()
+    seconds = []
+    for i in range(repeat):
+        start = time.time()
+        extract_time_table(add_start_time(df)).write.format("noop").mode("overwrite").save()
+        seconds.append(time.time() - start)
+
+    best = min(seconds)
+    return {
+        'run_at': datetime.now().isoformat(timespec='seconds'),
+        'variant': name,
+        'timezone': spark.conf.get("spark.sql.session.timeZone"),
+        'rows': rows,
+        'seconds': round(best, 3),
+        'rows_per_second': round(rows / best, 1) if best else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the Python udf with built-in expressions building the time table in local mode')
+    parser.add_argument('--log-data', default='data/log-data.zip', help='zip file of the log json files')
+    parser.add_argument('--timezone', default='UTC', help='session timezone of the timestamps')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each variant, the best one is kept')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='file the results are appended to as json lines')
+    args = parser.parse_args()
+
+    spark = SparkSession.builder \
+        .master("local[*]") \
+        .config("spark.sql.session.timeZone", args.timezone) \
+        .getOrCreate()
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        zipfile.ZipFile(args.log_data).extractall(log_dir)
+        df = spark.read.json(os.path.join(log_dir, '*.json')).filter(col("page") == "NextSong").cache()
+
+        print('{:>10} {:>9} {:>8} {:>10}'.format('variant', 'rows', 'seconds', 'rows/s'))
+        with open(args.results, 'a') as f:
+            for name, add_start_time in (('udf', with_start_time_udf), ('native', with_start_time)):
+                result = run_benchmark(spark, df, name, add_start_time, args.repeat)
+                f.write(json.dumps(result) + '\n')
+                print('{:>10} {:>9} {:>8.2f} {:>10}'.format(
+                    name, result['rows'], result['seconds'], result['rows_per_second']))
+
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 import configparser
-from datetime import datetime
+import argparse
+import json
+import math
 import os
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, monotonically_increasing_id
+import time
+from datetime import date
+from functools import reduce
+from urllib.request import urlopen
+from pyspark import StorageLevel
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.functions import col, row_number, broadcast, rand, explode, array, lit, sha2, concat_ws
 from pyspark.sql.functions import year, month, dayofmonth, dayofweek,hour, weekofyear, date_format
-from pyspark.sql.types import StructType as R, StructField as Fld, DoubleType as Dbl, StringType as Str, IntegerType as Int, DateType as Dat, TimestampType
+from pyspark.sql.types import StructType as R, StructField as Fld, DoubleType as Dbl, StringType as Str, IntegerType as Int, LongType as Lng, DateType as Dat, TimestampType
 
 
 
@@ -22,169 +29,709 @@ except Exception as e:
     print(e)
 
 
-def create_spark_session():
+songSchema = R([
+    Fld("artist_id",Str()),
+    Fld("artist_latitude",Dbl()),
+    Fld("artist_location",Str()),
+    Fld("artist_longitude",Dbl()),
+    Fld("artist_name",Str()),
+    Fld("song_id",Str()),
+    Fld("duration",Dbl()),
+    Fld("num_songs",Int()),
+    Fld("title",Str()),
+    Fld("year",Int()),
+])
+
+# userId is a string in the log files, empty for logged out users
+logSchema = R([
+    Fld("artist",Str()),
+    Fld("auth",Str()),
+    Fld("firstName",Str()),
+    Fld("gender",Str()),
+    Fld("itemInSession",Int()),
+    Fld("lastName",Str()),
+    Fld("length",Dbl()),
+    Fld("level",Str()),
+    Fld("location",Str()),
+    Fld("method",Str()),
+    Fld("page",Str()),
+    Fld("registration",Dbl()),
+    Fld("sessionId",Int()),
+    Fld("song",Str()),
+    Fld("status",Int()),
+    Fld("ts",Lng()),
+    Fld("userAgent",Str()),
+    Fld("userId",Str()),
+])
+
+# columns of the NextSong events read by the users, time and songplays tables
+songplay_fields = ["artist", "firstName", "gender", "lastName", "length", "level", "location",
+                   "sessionId", "song", "ts", "userAgent", "userId"]
+
+# partition columns of each table, songs were partitioned by artist_id too, one directory per artist
+DEFAULT_PARTITIONS = {
+    "songs": ["year"],
+    "artists": [],
+    "users": [],
+    "time": ["year", "month"],
+    "songplays": ["year", "month"],
+}
+
+# tables that can be bucketed by artist_id
+ARTIST_TABLES = ("songs", "artists", "songplays")
+
+# bytes per value of each type in the estimate of the size of a table, as Spark's defaultSize
+TYPE_SIZES = {"string": 20, "int": 4, "bigint": 8, "double": 8, "timestamp": 8, "date": 4}
+
+
+def create_spark_session(timezone="UTC"):
+    """Creates the SparkSession, timestamps are read and written in the given timezone
+    Args:
+        timezone (str): session timezone, e.g. UTC or America/New_York
+
+    Returns:
+        :obj:`pyspark.sql.session.SparkSession`: SparkSession
+    """
     spark = SparkSession \
         .builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.sql.session.timeZone", timezone) \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def with_start_time(df):
+    """Adds the start_time timestamp of the ts column, in epoch milliseconds, keeping the milliseconds.
+    Built-in expressions only, so rows never leave the JVM for a Python worker.
+    Args:
+        df(:obj:`pyspark.sql.DataFrame`): log events
+
+    Returns:
+        :obj:`pyspark.sql.DataFrame`: log events with start_time
+    """
+    return df.withColumn("start_time", (col("ts") / 1000).cast(TimestampType()))
+
+
+def extract_time_table(df):
+    """Breaks the start_time of the events down into the columns of the time table
+    Args:
+        df(:obj:`pyspark.sql.DataFrame`): log events with start_time, see `with_start_time`
+
+    Returns:
+        :obj:`pyspark.sql.DataFrame`: time table
+    """
+    time_fields = ["start_time", "hour(start_time) as hour", "dayofmonth(start_time) as day",
+                   "weekofyear(start_time) as week", "month(start_time) as month", "year(start_time) as year",
+                   "dayofweek(start_time) as weekday"]
+    return df.selectExpr(time_fields).dropDuplicates(["start_time"])
+
+
+def build_layout(partitions=None, target_file_size=128 * 1024 ** 2, sizing="repartition", buckets=0):
+    """Builds the output layout of the tables, see `write_table`
+    Args:
+        partitions (dict): table -> partition columns, DEFAULT_PARTITIONS if None
+        target_file_size (int): target size in bytes of the files written
+        sizing (str): 'repartition' shuffles the rows into files of about the target size, 'coalesce' merges
+            partitions into them without a shuffle, 'none' writes the partitions as they are
+        buckets (int): number of artist_id buckets of the tables having it, not bucketed if 0
+
+    Returns:
+        dict: table -> layout of the table
+    """
+    partitions = dict(DEFAULT_PARTITIONS, **(partitions or {}))
+    return {table: {"partition_by": columns,
+                    "target_file_size": target_file_size,
+                    "sizing": sizing,
+                    "buckets": buckets if table in ARTIST_TABLES else 0}
+            for table, columns in partitions.items()}
+
+
+def estimate_table_size(spark, df):
+    """Estimates the rows and uncompressed size of a table from the optimizer statistics, without
+    running its plan. The rows are the size over the sizes of its column types.
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        df(:obj:`pyspark.sql.DataFrame`): table
+
+    Returns:
+        tuple: rows and estimated size in bytes, None if the optimizer has no statistics of the table
+    """
+    size = estimate_size(df)
+    if size >= spark._jsparkSession.sessionState().conf().defaultSizeInBytes():
+        return None
+    row_size = sum(TYPE_SIZES.get(field.dataType.simpleString(), 8) for field in df.schema.fields)
+    return max(1, size // row_size), size
+
+
+def get_filesystem(spark, path):
+    """Returns the Hadoop filesystem of a path, local or on S3, and the path
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        path (str): path or glob pattern
+
+    Returns:
+        tuple: Hadoop FileSystem and Path
+    """
+    hadoop_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()), hadoop_path
+
+
+def path_exists(spark, path):
+    """Tells whether a path exists, local or on S3"""
+    fs, hadoop_path = get_filesystem(spark, path)
+    return fs.exists(hadoop_path)
+
+
+def glob_paths(spark, pattern):
+    """Lists the paths matching a glob pattern, local or on S3
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        pattern (str): glob pattern, e.g. s3a://udacity-dend/log_data/2018/11/*.json
+
+    Returns:
+        list: sorted paths matching the pattern
+    """
+    fs, hadoop_path = get_filesystem(spark, pattern)
+    return sorted(status.getPath().toString() for status in fs.globStatus(hadoop_path) or [])
+
+
+def replace_path(spark, source, target):
+    """Replaces a path with another one, deleting the target first
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        source (str): path moved
+        target (str): path replaced
+
+    Returns:
+        None
+    """
+    fs, target_path = get_filesystem(spark, target)
+    fs.delete(target_path, True)
+    fs.rename(get_filesystem(spark, source)[1], target_path)
+
+
+def summarize_output(spark, path):
+    """Counts the data files under an output path, local or on S3
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        path (str): output path of a table
+
+    Returns:
+        tuple: number of files and their size in bytes
+    """
+    fs, hadoop_path = get_filesystem(spark, path)
+    if not fs.exists(hadoop_path):
+        return 0, 0
+    files = fs.listFiles(hadoop_path, True)
+    count, size = 0, 0
+    while files.hasNext():
+        status = files.next()
+        if status.getPath().getName().startswith(("_", ".")):
+            continue
+        count += 1
+        size += status.getLen()
+    return count, size
+
+
+def write_table(spark, df, output_data, table, layout=None, summary=None, path=None):
+    """Writes a table to parquet files with its layout: partition columns, files of about the target
+    size and artist_id buckets. Large partitions are split into several files by capping the rows of a file.
+    Bucketed tables are saved in the session catalog too, as Spark only writes buckets with saveAsTable.
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        df(:obj:`pyspark.sql.DataFrame`): table
+        output_data (str): S3 bucket file path to store resulting files
+        table (str): name of the table
+        layout (dict): table -> layout of the table, see `build_layout`, the default layout if None
+        summary (list): the table, its files, size and time are appended to it, if set
+        path (str): path the table is written to, `output_data` + table.parquet if None
+
+    Returns:
+        bool: True if the table was written
+    """
+    table_layout = (layout or build_layout())[table]
+    partition_by = table_layout["partition_by"]
+    path = path or output_data + table + ".parquet"
+    written = True
+    start = time.time()
+    spark.sparkContext.setJobDescription("{} table".format(table))
+
+    try:
+        writer_df = df
+        records = 0
+        estimate = estimate_table_size(spark, df) if table_layout["sizing"] != "none" else None
+        if estimate:
+            rows, size = estimate
+            files = max(1, math.ceil(size / table_layout["target_file_size"]))
+            records = max(1, math.ceil(rows / files))
+            if table_layout["sizing"] == "coalesce":
+                writer_df = df.coalesce(files)
+            elif partition_by:
+                writer_df = df.repartition(*partition_by)
+            else:
+                writer_df = df.repartition(files)
+
+        writer = writer_df.write.mode("overwrite").option("maxRecordsPerFile", records)
+        if partition_by:
+            writer = writer.partitionBy(*partition_by)
+        if table_layout["buckets"]:
+            writer.bucketBy(table_layout["buckets"], "artist_id").sortBy("artist_id") \
+                .option("path", path).saveAsTable(table, format="parquet")
+        else:
+            writer.parquet(path)
+    except Exception as e:
+        print(e)
+        written = False
+
+    seconds = time.time() - start
+    files, size = summarize_output(spark, path)
+    print("**** {} table data load is complete, {} files, {:.1f} MB in {:.2f}s *****".format(
+        table, files, size / 1024 ** 2, seconds))
+    if summary is not None:
+        summary.append({"table": table, "partition_by": partition_by, "buckets": table_layout["buckets"],
+                        "files": files, "bytes": size, "seconds": seconds})
+    return written
+
+
+def merge_partitions(spark, df, output_data, table, keys, partition_by):
+    """Adds the rows already written in the partitions a table's new rows go to, so a dynamic partition
+    overwrite of those partitions keeps them. New rows replace the written ones with the same keys.
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        df(:obj:`pyspark.sql.DataFrame`): new rows of the table
+        output_data (str): S3 bucket file path the table is stored at
+        table (str): name of the table
+        keys (list): columns identifying a row
+        partition_by (list): partition columns of the table
+
+    Returns:
+        :obj:`pyspark.sql.DataFrame`: rows of the partitions to be written
+    """
+    path = output_data + table + ".parquet"
+    if not path_exists(spark, path):
+        return df
+
+    partitions = df.select(partition_by).distinct().collect()
+    if not partitions:
+        return df
+    in_partitions = reduce(lambda a, b: a | b, [
+        reduce(lambda a, b: a & b, [col(column) == row[column] for column in partition_by])
+        for row in partitions])
+    written = spark.read.parquet(path).filter(in_partitions).join(df.select(keys), keys, "left_anti")
+    return df.unionByName(written.select(df.columns))
+
+
+def merge_users(spark, users_table, output_data):
+    """Merges the users of new events with the users table written before, keeping the level of
+    each user's latest event
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        users_table(:obj:`pyspark.sql.DataFrame`): users of the new events, with last_seen
+        output_data (str): S3 bucket file path the users table is stored at
+
+    Returns:
+        :obj:`pyspark.sql.DataFrame`: users table
+    """
+    path = output_data + "users.parquet"
+    if not path_exists(spark, path):
+        return users_table
+
+    users = users_table.unionByName(spark.read.parquet(path).select(users_table.columns))
+    latest = Window.partitionBy("user_id").orderBy(col("last_seen").desc())
+    return users.withColumn("latest", row_number().over(latest)).filter(col("latest") == 1).drop("latest")
+
+
+def file_date(path):
+    """Parses the date of a log file named like 2018-11-01-events.json, None if it has no date"""
+    try:
+        return date.fromisoformat(os.path.basename(path)[:10])
+    except ValueError:
+        return None
+
+
+def list_log_files(spark, input_data, start_date=None, end_date=None):
+    """Lists the log files of a date range, listing only the log_data/YYYY/MM directories of the range
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        input_data (str): S3 bucket or directory of log_data
+        start_date (`datetime.date`): first date of the files listed, if set
+        end_date (`datetime.date`): last date of the files listed, if set
+
+    Returns:
+        list: sorted paths of the log files
+    """
+    if start_date is None:
+        files = glob_paths(spark, input_data + "log_data/*/*/*.json")
+    else:
+        last = end_date or date.today()
+        files = []
+        y, m = start_date.year, start_date.month
+        while (y, m) <= (last.year, last.month):
+            files += glob_paths(spark, "{}log_data/{}/{:02d}/*.json".format(input_data, y, m))
+            y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+
+    if start_date:
+        files = [f for f in files if file_date(f) and file_date(f) >= start_date]
+    if end_date:
+        files = [f for f in files if file_date(f) and file_date(f) <= end_date]
+    return files
+
+
+def read_checkpoint(spark, checkpoint):
+    """Reads the log files processed by earlier runs
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        checkpoint (str): path of the processed files checkpoint, local or on S3
+
+    Returns:
+        set: paths of the processed log files
+    """
+    if not path_exists(spark, checkpoint):
+        return set()
+    return {row.value for row in spark.read.text(checkpoint).collect()}
+
+
+def write_checkpoint(spark, checkpoint, files):
+    """Adds log files to the processed files checkpoint
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+        checkpoint (str): path of the processed files checkpoint, local or on S3
+        files (list): paths of the log files processed
+
+    Returns:
+        None
+    """
+    spark.createDataFrame([(f,) for f in files], "value string").coalesce(1).write.mode("append").text(checkpoint)
+
+
+def print_write_summary(summary):
+    """Prints the layout, files, size and time of each table written
+    Args:
+        summary (list): tables written, see `write_table`
+
+    Returns:
+        None
+    """
+    print("{:<10} {:<12} {:>7} {:>7} {:>10} {:>12} {:>8}".format(
+        "table", "partitions", "buckets", "files", "MB", "MB per file", "seconds"))
+    for item in summary:
+        print("{:<10} {:<12} {:>7} {:>7} {:>10.1f} {:>12.2f} {:>8.2f}".format(
+            item["table"], ",".join(item["partition_by"]) or "-", item["buckets"] or "-", item["files"],
+            item["bytes"] / 1024 ** 2, item["bytes"] / 1024 ** 2 / item["files"] if item["files"] else 0,
+            item["seconds"]))
+
+
+def process_song_data(spark, input_data, output_data, storage_level="MEMORY_AND_DISK", layout=None, summary=None):
     """This function loads song_data from S3 and processes it by extracting the songs and artist tables
         and then again loaded back to S3
     Args:
         spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
         input_data (str): S3 bucket where song files are stored
         output (str): S3 bucket file path to store resulting files
+        storage_level (str): name of the `pyspark.StorageLevel` the song data is persisted with
+        layout (dict): output layout of the tables, see `build_layout`
+        summary (list): the tables written are appended to it, if set, see `write_table`
 
     Returns:
-        None
+        :obj:`pyspark.sql.DataFrame`: title, name, duration, song_id and artist_id of the songs, the song
+            lookup of the songplays, see `process_log_data`. Built from the persisted song data, which is
+            kept until the session's cache is cleared.
     """
     print("**** Starting to process song data *****")
     # get filepath to song data file
     song_data = input_data+'song_data/*/*/*/*.json'
     
     # read song data file
-    
-    songSchema = R([
-        Fld("artist_id",Str()),
-        Fld("artist_latitude",Dbl()),
-        Fld("artist_location",Str()),
-        Fld("artist_longitude",Dbl()),
-        Fld("artist_name",Str()),
-        Fld("song_id",Str()),
-        Fld("duration",Dbl()),
-        Fld("num_songs",Int()),
-        Fld("title",Str()),
-        Fld("year",Int()),
-    ])
-    
-    
     try:
         df = spark.read.json(song_data, schema=songSchema)
     except Exception as e:
         print(e)
+    df = df.persist(getattr(StorageLevel, storage_level))
         
     # extract columns to create songs table
     songs_fields = ["song_id", "title", "artist_id", "year", "duration"]
     songs_table = df.select(songs_fields).dropDuplicates(["song_id"])
     
-    # write songs table to parquet files partitioned by year and artist
-    try:
-        songs_table.write.parquet(output_data + "songs.parquet", partitionBy=("year", "artist_id"), mode="overwrite")
-    except Exception as e:
-        print(e)
-    
-    print("**** songs table data load is complete *****")
+    # write songs table to parquet files, partitioned by year by default
+    write_table(spark, songs_table, output_data, "songs", layout, summary)
     
     # extract columns to create artists table
     artists_fields = ["artist_id", "artist_name as name", "artist_location as location", "artist_latitude as lattitude", "artist_longitude as longitude"]
     artists_table = df.selectExpr(artists_fields).dropDuplicates(["artist_id"])
     
     # write artists table to parquet files
-    try:
-        artists_table.write.parquet(output_data + "artists.parquet",  mode="overwrite")
-    except Exception as e:
-        print(e)
-    print("**** artists table data load is complete *****")
+    write_table(spark, artists_table, output_data, "artists", layout, summary)
+
+    song_df = songs_table.join(artists_table.select("artist_id", "name"), "artist_id") \
+        .select("title", "name", "duration", "song_id", "artist_id")
     
     print("**** song data processing is finished *****")
+    return song_df
+
+
+def estimate_size(df):
+    """Size in bytes of a DataFrame as estimated by the optimizer, the one compared with
+    spark.sql.autoBroadcastJoinThreshold. Exact once the data it is built from is cached.
+    Args:
+        df(:obj:`pyspark.sql.DataFrame`): DataFrame
+
+    Returns:
+        int: estimated size in bytes
+    """
+    return int(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes().toString())
+
 
+def join_songs(df, song_df, broadcast_threshold=64 * 1024 * 1024, salt_buckets=8):
+    """Joins the log events with the songs they played on title, artist name and duration.
+    A song lookup under `broadcast_threshold` bytes is broadcast to every executor, so the events are
+    not shuffled. A larger one is joined on a salt too: each event gets one of `salt_buckets` salts
+    at random and each song is copied once per salt, so the events of a popular title are spread
+    over `salt_buckets` tasks instead of one. The lookup keeps one song per join key, the lowest song_id,
+    so an event matching several songs gives a single songplay.
+    Args:
+        df(:obj:`pyspark.sql.DataFrame`): log events
+        song_df(:obj:`pyspark.sql.DataFrame`): title, name, duration, song_id and artist_id of the songs
+        broadcast_threshold (int): maximum size in bytes of a broadcast song lookup
+        salt_buckets (int): number of salts of a salted join
 
-def process_log_data(spark, input_data, output_data):
+    Returns:
+        tuple: joined :obj:`pyspark.sql.DataFrame`, strategy ('broadcast' or 'salted') and estimated
+            size in bytes of the song lookup
+    """
+    first = Window.partitionBy("title", "name", "duration").orderBy("song_id")
+    song_df = song_df.withColumn("first", row_number().over(first)).filter(col("first") == 1).drop("first")
+
+    size = estimate_size(song_df)
+    if size <= broadcast_threshold:
+        song_df = broadcast(song_df)
+        condition = (df.song == song_df.title) & (df.artist == song_df.name) & (df.length == song_df.duration)
+        return df.join(song_df, condition, "inner"), "broadcast", size
+
+    events = df.withColumn("salt", (rand() * salt_buckets).cast("int"))
+    songs = song_df.withColumn("song_salt", explode(array([lit(i) for i in range(salt_buckets)])))
+    condition = (events.song == songs.title) & (events.artist == songs.name) & (events.length == songs.duration) \
+        & (events.salt == songs.song_salt)
+    return events.join(songs, condition, "inner").drop("salt", "song_salt"), "salted", size
+
+
+def process_log_data(spark, input_data, output_data, storage_level="MEMORY_AND_DISK", song_df=None,
+                     broadcast_threshold=64 * 1024 * 1024, salt_buckets=8, layout=None, summary=None,
+                     log_files=None, incremental=False):
     """This function loads log_data from S3 and processes it by extracting the users and time dimension tables
-        and songplays fact table then again loaded back to S3
+        and songplays fact table then again loaded back to S3.
+        The log files are scanned once: the NextSong events are persisted with the columns the three tables need.
     Args:
         spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
         input_data (str): S3 bucket where song files are stored
         output (str): S3 bucket file path to store resulting files
+        storage_level (str): name of the `pyspark.StorageLevel` the NextSong events are persisted with
+        song_df(:obj:`pyspark.sql.DataFrame`): song lookup returned by `process_song_data` in the same
+            session, read back from the songs and artists tables if None
+        broadcast_threshold (int): maximum size in bytes of a broadcast song lookup, see `join_songs`
+        salt_buckets (int): number of salts of the join with a larger song lookup
+        layout (dict): output layout of the tables, see `build_layout`
+        summary (list): the tables written are appended to it, if set, see `write_table`
+        log_files (list): paths of the log files processed, all the files of log_data if None
+        incremental (bool): merges the tables with the ones written before: users keep the level of their
+            latest event and the partitions of time and songplays with new rows are rewritten, with the
+            rows they held. Needs spark.sql.sources.partitionOverwriteMode set to dynamic.
 
     Returns:
-        None
+        bool: True if every table was written
     """
     print("**** Starting to process log data *****")
     # get filepath to log data file
-    log_data = input_data+'log_data/*/*/*.json'
+    log_data = input_data+'log_data/*/*/*.json' if log_files is None else log_files
 
     # read log data file
     try:
-        df =spark.read.json(log_data)
+        df = spark.read.json(log_data, schema=logSchema)
     except Exception as e:
         print(e)
     
-    # filter by actions for song plays
-    df = df.filter(df.page == "NextSong")
+    # filter by actions for song plays, keeping the columns of the tables, and create start_time column
+    # from original timestamp column
+    df = with_start_time(df.filter(df.page == "NextSong").select(songplay_fields))
+    df = df.persist(getattr(StorageLevel, storage_level))
+    spark.sparkContext.setJobDescription("scan log_data")
+    print("**** {} NextSong events persisted {} *****".format(df.count(), storage_level))
 
-    # extract columns for users table    
-    users_fields = ["userId as user_id", "firstName as first_name", "lastName as last_name", "gender", "level","ts"]
-    users_table = df.selectExpr(users_fields).orderBy("ts",ascending=False).dropDuplicates(["userId"]).drop("ts")
+    # extract columns for users table, with the level of their latest event
+    latest = Window.partitionBy("userId").orderBy(col("ts").desc())
+    users_fields = ["cast(userId as int) as user_id", "firstName as first_name", "lastName as last_name", "gender", "level",
+                    "start_time as last_seen"]
+    users_table = df.filter(df.userId != "").withColumn("latest", row_number().over(latest)) \
+        .filter(col("latest") == 1).selectExpr(users_fields)
+    layout = layout or build_layout()
     
-    # write users table to parquet files
-    try:
-        users_table.write.parquet(output_data + "users.parquet",  mode="overwrite")
-    except Exception as e:
-        print(e)
-        
-    print("**** users table data load is complete *****")
+    # write users table to parquet files, merged with the users written before through a new path,
+    # as a table cannot be overwritten while it is read
+    if incremental:
+        users_path = output_data + "users.parquet.merged"
+        written = write_table(spark, merge_users(spark, users_table, output_data), output_data, "users",
+                              layout, summary, path=users_path)
+        if written:
+            replace_path(spark, users_path, output_data + "users.parquet")
+    else:
+        written = write_table(spark, users_table, output_data, "users", layout, summary)
 
-    # create timestamp column from original timestamp column
-    #get_timestamp = udf(date_convert, TimestampType())
-    #df = df.withColumn("datetime",get_timestamp(df.ts))
-    
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda ms: datetime.fromtimestamp(ms // 1000), TimestampType())
-    df = df.withColumn("datetime",get_timestamp(df.ts))
-       
     # extract columns to create time table
-    time_fields = ["datetime as start_time", "hour(datetime) as hour", "dayofmonth(datetime) as day",
-                   "weekofyear(datetime) as week", "month(datetime) as month", "year(datetime) as year", 
-                   "dayofweek(datetime) as weekday"]
-    time_table = df.select(time_fields).dropDuplicates(["start_time"])
-    
-    # write time table to parquet files partitioned by year and month
-    try:
-        time_table.write.parquet(output_data + "time.parquet", partitionBy=("year", "month"), mode="overwrite")
-    except Exception as e:
-        print(e)
+    time_table = extract_time_table(df)
+    if incremental:
+        time_table = merge_partitions(spark, time_table, output_data, "time", ["start_time"],
+                                      layout["time"]["partition_by"])
     
-    print("**** time table data load is complete *****")
+    # write time table to parquet files, partitioned by year and month by default
+    written &= write_table(spark, time_table, output_data, "time", layout, summary)
 
-    # read in song data to use for songplays table
-    songs_df = spark.read.parquet(output_data + "songs.parquet")
-    
-    artists_df = spark.read.parquet(output_data + "artists.parquet")
-    
-    song_df = songs_df.join(artists_df.aslias("artists"), 
-                            songs_df.artist_id == artists_df.artist_id , 
-                            "inner" ).select("title", "name", "duration", "song_id", "artists.artist_id")
+    # read in song data to use for songplays table, unless processed in this session
+    if song_df is None:
+        songs_df = spark.read.parquet(output_data + "songs.parquet")
+        
+        artists_df = spark.read.parquet(output_data + "artists.parquet")
+        
+        song_df = songs_df.join(artists_df.alias("artists"), 
+                                songs_df.artist_id == artists_df.artist_id , 
+                                "inner" ).select("title", "name", "duration", "song_id", "artists.artist_id")
 
     # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = df.join(song_df , (df.song == song_df.title) & (df.artist ==song_df.name) & (df.length == song_df.duration), "inner")
-    songplays_table = songplays_table.withColumn("songplay_id",monotonically_increasing_id())
-    songplays_table = songplays_table.selectExpr("songplay_id", "datetime as start_time", "userId as user_id",
-                                                 "month(datetime) as month", "year(datetime) as year",
+    songplays_table, strategy, size = join_songs(df, song_df, broadcast_threshold, salt_buckets)
+    print("**** songplays join: {} ({:.1f} MB song lookup, threshold {:.1f} MB) *****".format(
+        strategy, size / 1024 ** 2, broadcast_threshold / 1024 ** 2))
+    # the id is a hash of the event, so runs merging new events into the partitions written before
+    # give the same event the same id and never reuse the id of another one
+    songplays_table = songplays_table.withColumn(
+        "songplay_id", sha2(concat_ws("|", col("ts"), col("userId"), col("sessionId")), 256))
+    songplays_table = songplays_table.selectExpr("songplay_id", "start_time", "cast(userId as int) as user_id",
+                                                 "month(start_time) as month", "year(start_time) as year",
                                                  "level", "song_id", "artist_id","sessionId as session_id",
-                                                 "location", "userAgent as user_agent").dropDuplicates()
+                                                 "location", "userAgent as user_agent") \
+        .dropDuplicates(["songplay_id"])
+    if incremental:
+        songplays_table = merge_partitions(spark, songplays_table, output_data, "songplays",
+                                           ["start_time", "user_id", "session_id"],
+                                           layout["songplays"]["partition_by"])
     
-    # write songplays table to parquet files partitioned by year and month
+    # write songplays table to parquet files, partitioned by year and month by default
+    start = time.time()
+    written &= write_table(spark, songplays_table, output_data, "songplays", layout, summary)
+    print("**** songplays {} join and write in {:.2f}s *****".format(strategy, time.time() - start))
+
+    spark.sparkContext.setJobDescription(None)
+    df.unpersist()
+    print("**** log data processing is finished *****")
+    return written
+
+
+def print_scan_report(spark):
+    """Prints the file scans of each query run by the session, from the SQL metrics of the Spark UI,
+    to check that the log files are scanned once
+    Args:
+        spark(:obj:`pyspark.sql.session.SparkSession`): SparkSession
+
+    Returns:
+        None
+    """
+    sc = spark.sparkContext
+    if not sc.uiWebUrl:
+        print("Spark UI is disabled, no scan report")
+        return
+
+    url = "{}/api/v1/applications/{}/sql?details=true&length=1000".format(sc.uiWebUrl, sc.applicationId)
     try:
-        songplays_table.write.parquet(output_data + "songplays.parquet", partitionBy=("year", "month"), mode="overwrite")
+        executions = json.load(urlopen(url))
     except Exception as e:
         print(e)
+        return
 
-    print("**** songplays table data load is complete *****")
-    
-    print("**** log data processing is finished *****")
+    scans = 0
+    for execution in executions:
+        for node in execution.get("nodes", []):
+            if not node["nodeName"].startswith("Scan"):
+                continue
+            metrics = {metric["name"]: metric["value"] for metric in node.get("metrics", [])}
+            print("{:<20} {:<25} files read: {:>8}, rows: {:>10}".format(
+                execution["description"][:20], node["nodeName"].strip(),
+                metrics.get("number of files read", "-"), metrics.get("number of output rows", "-")))
+            scans += node["nodeName"].strip() == "Scan json"
+    print("**** {} scans of json files *****".format(scans))
 
 
 def main():
-    spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://sparkify-dend/"
+    parser = argparse.ArgumentParser(description='Processes song_data and log_data into the dimensional tables')
+    parser.add_argument('--input-data', default="s3a://udacity-dend/", help='bucket or directory of song_data and log_data')
+    parser.add_argument('--output-data', default="s3a://sparkify-dend/", help='bucket or directory the tables are written to')
+    parser.add_argument('--timezone', default="UTC", help='session timezone of the timestamps, e.g. UTC')
+    parser.add_argument('--storage-level', default="MEMORY_AND_DISK",
+                        choices=[name for name in dir(StorageLevel) if name.isupper()],
+                        help='storage level the song data and the NextSong events are persisted with')
+    parser.add_argument('--broadcast-threshold', type=int, default=64 * 1024 * 1024,
+                        help='maximum size in bytes of a song lookup broadcast to the songplays join, '
+                             'larger ones are joined with salts')
+    parser.add_argument('--salt-buckets', type=int, default=8,
+                        help='number of salts spreading the events of a popular song in a salted join')
+    parser.add_argument('--partition-by', nargs='*', default=[], metavar='TABLE=COLUMNS',
+                        help='partition columns of a table, e.g. songs=year time=year,month users= '
+                             '(default: {})'.format(' '.join('{}={}'.format(table, ','.join(columns))
+                                                             for table, columns in DEFAULT_PARTITIONS.items())))
+    parser.add_argument('--target-file-mb', type=float, default=128, help='target size in MB of the files written')
+    parser.add_argument('--file-sizing', choices=('repartition', 'coalesce', 'none'), default='repartition',
+                        help='repartition: shuffles the rows into files of about the target size, '
+                             'coalesce: merges partitions without a shuffle, none: writes partitions as they are')
+    parser.add_argument('--bucket-artists', type=int, default=0,
+                        help='number of artist_id buckets of songs, artists and songplays, not bucketed if 0')
+    parser.add_argument('--incremental', action='store_true',
+                        help='processes only the log files of a date range, or not in the checkpoint, and merges '
+                             'them into the tables written before, leaving the song data as it is')
+    parser.add_argument('--start-date', type=date.fromisoformat, help='first date of the log files, YYYY-MM-DD')
+    parser.add_argument('--end-date', type=date.fromisoformat, help='last date of the log files, YYYY-MM-DD')
+    parser.add_argument('--checkpoint', metavar='PATH',
+                        help='processed files checkpoint, log files in it are skipped and the processed ones '
+                             'added to it (default: <output-data>_checkpoint/log_files, only read without '
+                             'a date range)')
+    args = parser.parse_args()
+
+    spark = create_spark_session(args.timezone)
+    input_data = args.input_data
+    output_data = args.output_data
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    partitions = {}
+    for item in args.partition_by:
+        table, _, columns = item.partition("=")
+        partitions[table] = [column for column in columns.split(",") if column]
+    layout = build_layout(partitions, int(args.target_file_mb * 1024 ** 2), args.file_sizing, args.bucket_artists)
+    summary = []
+
+    if args.incremental:
+        if not layout["time"]["partition_by"] or not layout["songplays"]["partition_by"]:
+            parser.error('--incremental rewrites partitions of time and songplays, they must be partitioned')
+        if args.bucket_artists:
+            parser.error('--incremental does not write bucketed tables')
+        spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+
+        checkpoint = args.checkpoint or output_data + "_checkpoint/log_files"
+        log_files = list_log_files(spark, input_data, args.start_date, args.end_date)
+        # a date range is processed again, unless a checkpoint is given
+        use_checkpoint = args.checkpoint or not (args.start_date or args.end_date)
+        processed = read_checkpoint(spark, checkpoint) if use_checkpoint else set()
+        new_files = [f for f in log_files if f not in processed]
+        print("**** {} log files found, {} not processed yet *****".format(len(log_files), len(new_files)))
+        if new_files:
+            written = process_log_data(spark, input_data, output_data, args.storage_level,
+                                       broadcast_threshold=args.broadcast_threshold, salt_buckets=args.salt_buckets,
+                                       layout=layout, summary=summary, log_files=new_files, incremental=True)
+            if written:
+                write_checkpoint(spark, checkpoint, new_files)
+            else:
+                print("**** tables not written, log files not added to the checkpoint *****")
+    else:
+        song_df = process_song_data(spark, input_data, output_data, args.storage_level, layout, summary)
+        process_log_data(spark, input_data, output_data, args.storage_level, song_df=song_df,
+                         broadcast_threshold=args.broadcast_threshold, salt_buckets=args.salt_buckets,
+                         layout=layout, summary=summary)
+    print_write_summary(summary)
+    print_scan_report(spark)
+    spark.catalog.clearCache()
 
 
 if __name__ == "__main__":